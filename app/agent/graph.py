@@ -1,30 +1,15 @@
 from langgraph.graph import StateGraph, END
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, ToolMessage, AIMessage, HumanMessage
+from langchain_core.messages import SystemMessage, ToolMessage, AIMessage, HumanMessage, message_chunk_to_message
 from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
-from langgraph.prebuilt import ToolNode
-from psycopg_pool import AsyncConnectionPool
-import os
-
-# FIX: Import the new tool
-from app.agent.tools import (
-    list_all_routes,
-    list_stops_for_path,
-    get_trip_details,
-    create_new_stop,
-    create_new_path,
-    create_new_route,
-    create_new_driver,
-    assign_vehicle_to_trip,
-    remove_vehicle_from_trip_action,
-    update_trip_progress,
-    search_knowledge_base,
-    list_todays_trips,
-    list_unassigned_vehicles,
-    search_stops,
-)
+import asyncio
+import datetime
+import orjson
+import uuid
 
+from app.agent.tools import TOOLS, TOOLS_BY_NAME
 from app.agent.state import AgentState
+from app.core.db import pool, fetch_all
 
 # --- 1. SETUP & PROMPT ---
 SYSTEM_PROMPT = """You are 'Movi', an expert transport manager AI.
@@ -71,101 +56,169 @@ You understand the Stop → Path → Route → Trip data model and manage daily
    - If asked for stops near a place, use `search_stops` with the place name to see if matches exist.
 """
 
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-
-tools = [
-    list_all_routes,
-    list_stops_for_path,
-    get_trip_details,
-    create_new_stop,
-    create_new_path,
-    create_new_route,
-    create_new_driver,
-    assign_vehicle_to_trip,
-    remove_vehicle_from_trip_action,
-    update_trip_progress,
-    search_knowledge_base,
-    list_todays_trips,
-    list_unassigned_vehicles,
-    search_stops,
-]
-
-llm_with_tools = llm.bind_tools(tools)
+# SYS_MSG + tool schemas form an identical prefix on every call, so OpenAI's
+# prompt cache can serve it; the cache key keeps our requests routed together.
+SYS_MSG = SystemMessage(content=SYSTEM_PROMPT)
+
+llm = ChatOpenAI(
+    model="gpt-4o-mini",
+    temperature=0,
+    streaming=True,
+    max_retries=2,
+    extra_body={"prompt_cache_key": "movi_v1"},
+)
+
+# Independent lookups come back as one batch of tool calls, which tools_node runs concurrently
+llm_with_tools = llm.bind_tools(TOOLS, parallel_tool_calls=True, tool_choice="auto")
 
 # --- 2. DATABASE CONNECTION POOL ---
-DB_URI = os.getenv("DB_URI")
-connection_kwargs = {
-    "autocommit": True,
-    "prepare_threshold": None, 
-}
-pool = AsyncConnectionPool(conninfo=DB_URI, kwargs=connection_kwargs, open=False)
+# `pool` lives in app.core.db so the checkpointer and the tools share one set of connections.
 
 # --- 3. NODES ---
 
+async def call_llm(messages):
+    """Stream the completion and merge the chunks into a single AIMessage."""
+    response = None
+    async for chunk in llm_with_tools.astream(messages):
+        response = chunk if response is None else response + chunk
+    return message_chunk_to_message(response)
+
+def update_trip_name_index(messages, index):
+    """Fold list_todays_trips results from the latest tool round into the Name -> ID memo."""
+    for msg in reversed(messages):
+        if not isinstance(msg, ToolMessage):
+            break
+        if msg.name != "list_todays_trips":
+            continue
+        try:
+            trips = orjson.loads(msg.content)
+        except (TypeError, ValueError):
+            continue
+        for trip in trips:
+            if trip.get("display_name") and trip.get("trip_id"):
+                index[trip["display_name"]] = str(trip["trip_id"])
+    return index
+
+def lookup_trip_names(text, index):
+    """
+    Answer the prompt's mandatory `list_todays_trips` lookup from the memo.
+    Returns a synthetic tool call + result pair when the user message names known trips.
+    """
+    text = text.lower()
+    matches = [{"trip_id": trip_id, "display_name": name} for name, trip_id in index.items() if name.lower() in text]
+    if not matches:
+        return []
+    call_id = f"call_{uuid.uuid4().hex[:8]}"
+    return [
+        AIMessage(content="", tool_calls=[{"name": "list_todays_trips", "args": {}, "id": call_id}]),
+        ToolMessage(
+            tool_call_id=call_id,
+            name="list_todays_trips",
+            content=f"Cached lookup (only the trips named in the request): {orjson.dumps(matches).decode()}",
+        ),
+    ]
+
 async def agent_node(state: AgentState):
     messages = state["messages"]
+    # Set when a confirmation is resolved without the shortcut below; merged into the LLM turn
+    resolved = {}
     
     if state.get("awaiting_confirmation"):
         last_user_msg = messages[-1].content.lower()
-        if "yes" in last_user_msg or "proceed" in last_user_msg:
-            trip_id = state.get("target_trip_id")
-            recovery_msg = HumanMessage(content=f"User confirmed safety check. Execute the removal of vehicle from trip {trip_id} now.")
-            response = await llm_with_tools.ainvoke(messages + [recovery_msg])
+        trip_ids = [t for t in (state.get("pending_removals") or [state.get("target_trip_id")]) if t]
+        if trip_ids and ("yes" in last_user_msg or "proceed" in last_user_msg):
+            recovery_msg = HumanMessage(content=f"User confirmed safety check. Execute the removal of vehicle from trip {', '.join(map(str, trip_ids))} now.")
+            # The action is already pinned, so call the tool directly instead of asking the LLM.
+            # route_logic sees the "User confirmed" message and goes straight to tools.
+            response = AIMessage(content="", tool_calls=[
+                {
+                    "name": "remove_vehicle_from_trip_action",
+                    "args": {"trip_id": trip_id},
+                    "id": f"call_{uuid.uuid4().hex[:8]}",
+                }
+                for trip_id in trip_ids
+            ])
             return {
                 "messages": [recovery_msg, response],
                 "awaiting_confirmation": False, 
                 "consequence_risk": None
             }
-        else:
+        elif trip_ids:
             return {
                 "messages": [AIMessage(content="Okay, operation cancelled.")],
                 "awaiting_confirmation": False,
-                "target_trip_id": None
+                "target_trip_id": None,
+                "pending_removals": None
             }
+        else:
+            # Nothing is actually pending: clear the flag and let the LLM answer the turn
+            resolved = {"awaiting_confirmation": False, "consequence_risk": None}
 
     if len(messages) == 0 or not isinstance(messages[0], SystemMessage):
-        messages = [SystemMessage(content=SYSTEM_PROMPT)] + messages
-        
-    response = await llm_with_tools.ainvoke(messages)
-    return {"messages": [response]}
+        messages = [SYS_MSG] + messages
+
+    # Yesterday's trip_ids must never be replayed as today's list_todays_trips result
+    today = datetime.date.today().isoformat()
+    known = state.get("trip_name_index") if state.get("trip_name_index_date") == today else None
+    trip_name_index = update_trip_name_index(messages, dict(known or {}))
+    lookup = []
+    if trip_name_index and isinstance(messages[-1], HumanMessage):
+        lookup = lookup_trip_names(messages[-1].content, trip_name_index)
+
+    response = await call_llm(messages + lookup)
+    return {
+        "messages": lookup + [response],
+        "trip_name_index": trip_name_index,
+        "trip_name_index_date": today,
+        **resolved,
+    }
 
 async def check_consequences_node(state: AgentState):
     last_message = state["messages"][-1]
-    trip_id = None
-    tool_call_id = None
-    
-    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-        for tool in last_message.tool_calls:
-            if tool["name"] == "remove_vehicle_from_trip_action":
-                trip_id = tool["args"].get("trip_id")
-                tool_call_id = tool["id"]
-                break
+    tool_calls = getattr(last_message, "tool_calls", None) or []
+    trip_ids = [
+        tool["args"].get("trip_id")
+        for tool in tool_calls
+        if tool["name"] == "remove_vehicle_from_trip_action" and tool["args"].get("trip_id")
+    ]
     
-    state_update = {"target_trip_id": trip_id}
+    state_update = {"target_trip_id": trip_ids[0] if trip_ids else None, "pending_removals": trip_ids}
     
-    if not trip_id:
+    if not trip_ids:
         return {**state_update, "consequence_risk": "LOW"}
 
-    print(f"🕵️ Checking consequences for Trip: {trip_id}")
-    from app.core.db import supabase
-    response = supabase.table("daily_trips").select("booking_status_percentage").eq("trip_id", trip_id).execute()
+    print(f"🕵️ Checking consequences for Trips: {', '.join(trip_ids)}")
+    # One round-trip for every removal proposed in this turn
+    rows = await fetch_all(
+        "SELECT trip_id, booking_status_percentage FROM daily_trips WHERE trip_id = ANY(%s)", (trip_ids,)
+    )
+    booked = {
+        str(row["trip_id"]): row["booking_status_percentage"]
+        for row in rows
+        if row["booking_status_percentage"] and row["booking_status_percentage"] > 0
+    }
     
     risk = "LOW"
     msg = None
     messages_to_add = []
     
-    if response.data:
-        booking_pct = response.data[0]['booking_status_percentage']
-        if booking_pct > 0:
-            risk = "HIGH"
+    if booked:
+        risk = "HIGH"
+        if len(booked) == 1:
+            booking_pct = next(iter(booked.values()))
             msg = f"⚠️ **WAIT!** This trip is **{booking_pct}% booked**. Removing the vehicle will cancel these bookings.\n\nDo you want to proceed?"
-            
-            if tool_call_id:
-                fake_tool_output = ToolMessage(
-                    tool_call_id=tool_call_id,
-                    content=f"SAFETY INTERLOCK: Trip is {booking_pct}% booked. Action paused pending user confirmation."
-                )
-                messages_to_add.append(fake_tool_output)
+        else:
+            details = "\n".join(f"- **{trip_id}**: {pct}% booked" for trip_id, pct in booked.items())
+            msg = f"⚠️ **WAIT!** These trips already have bookings:\n{details}\n\nRemoving the vehicles will cancel these bookings. Do you want to proceed?"
+
+        # Every pending tool call needs a result before the next model turn
+        for tool in tool_calls:
+            trip_id = tool["args"].get("trip_id")
+            if tool["name"] == "remove_vehicle_from_trip_action" and trip_id in booked:
+                content = f"SAFETY INTERLOCK: Trip is {booked[trip_id]}% booked. Action paused pending user confirmation."
+            else:
+                content = "SAFETY INTERLOCK: Action paused pending user confirmation."
+            messages_to_add.append(ToolMessage(tool_call_id=tool["id"], content=content))
 
     return {
         **state_update,
@@ -174,6 +227,28 @@ async def check_consequences_node(state: AgentState):
         "messages": messages_to_add
     }
 
+async def run_tool_call(call):
+    tool = TOOLS_BY_NAME.get(call["name"])
+    if tool is None:
+        return ToolMessage(
+            tool_call_id=call["id"],
+            name=call["name"],
+            content=f"Error: {call['name']} is not a valid tool.",
+            status="error",
+        )
+    try:
+        content = await tool.ainvoke(call["args"])
+    except Exception as e:
+        content = f"Error: {e!r}\n Please fix your mistakes."
+        return ToolMessage(tool_call_id=call["id"], name=call["name"], content=content, status="error")
+    return ToolMessage(tool_call_id=call["id"], name=call["name"], content=content)
+
+async def tools_node(state: AgentState):
+    # Independent lookups (e.g. several search_stops for one path) share one wall-clock round-trip
+    calls = state["messages"][-1].tool_calls
+    results = await asyncio.gather(*(run_tool_call(call) for call in calls))
+    return {"messages": list(results)}
+
 # --- 4. EDGES ---
 
 def route_logic(state: AgentState):
@@ -202,7 +277,7 @@ def decision_logic(state: AgentState):
 workflow = StateGraph(AgentState)
 workflow.add_node("agent", agent_node)
 workflow.add_node("check_consequences", check_consequences_node)
-workflow.add_node("tools", ToolNode(tools))
+workflow.add_node("tools", tools_node)
 workflow.add_node("ask_confirmation", lambda x: {
     "messages": [AIMessage(content=x["consequence_message"])], 
     "awaiting_confirmation": True
@@ -215,8 +290,26 @@ workflow.add_edge("tools", "agent")
 workflow.add_edge("ask_confirmation", END)
 
 # --- 6. INITIALIZER ---
+APP = None  # compiled graph, shared by every request in this process
+_APP_LOCK = asyncio.Lock()
+
 async def init_graph():
     checkpointer = AsyncPostgresSaver(pool)
     await checkpointer.setup() 
     app = workflow.compile(checkpointer=checkpointer)
     return app
+
+async def startup():
+    """Open the Postgres pool and compile the graph once, at process start."""
+    await get_app()
+
+async def get_app():
+    """Return the process-wide compiled graph, building it on first use."""
+    global APP
+    if APP is None:
+        async with _APP_LOCK:
+            # Concurrent first callers wait here and reuse the graph built by the winner
+            if APP is None:
+                await pool.open(wait=True)
+                APP = await init_graph()
+    return APP
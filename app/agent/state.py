@@ -1,5 +1,5 @@
 import operator
-from typing import Annotated, List, Optional, TypedDict, Union
+from typing import Annotated, Dict, List, Optional, TypedDict, Union
 from langchain_core.messages import BaseMessage
 
 class AgentState(TypedDict):
@@ -11,6 +11,12 @@ class AgentState(TypedDict):
     
     # 3. Operation Context (The "Tribal Knowledge" variables)
     target_trip_id: Optional[str]  # The ID of the trip being modified
+    pending_removals: Optional[List[str]]  # Every trip in the paused removal batch
     consequence_risk: Optional[str]  # 'HIGH', 'LOW', or None
     consequence_message: Optional[str] # "Warning: Trip is 25% booked."
-    awaiting_confirmation: bool # True if we are waiting for user to say "Yes"
\ No newline at end of file
+    awaiting_confirmation: bool # True if we are waiting for user to say "Yes"
+
+    # 4. Lookup Memo (last write wins; daily_trips change every day, so it is dropped
+    #    once trip_name_index_date is no longer today)
+    trip_name_index: Optional[Dict[str, str]]  # display_name -> trip_id
+    trip_name_index_date: Optional[str]  # ISO date the memo was built on
\ No newline at end of file
@@ -1,45 +1,96 @@
 from langchain_core.tools import tool
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import SupabaseVectorStore
-from app.core.db import supabase
-import json
+from asyncache import cached
+from cachetools import LRUCache, TTLCache
+from cachetools.keys import hashkey
+from psycopg.types.json import Jsonb
+from app.core.db import supabase, fetch_json, execute
+from app.core.cache import invalidate, register
+import numpy as np
+import uuid
+
+# Tool DB access goes through the async Postgres pool so a slow query never
+# stalls the event loop shared with voice streaming and the LangGraph scheduler.
+
+# --- READ CACHES ---
+# The agent re-runs the same lookups many times per conversation (e.g. Name -> ID
+# mapping via list_todays_trips), so read results are kept for a short TTL.
+# They are registered with app.core.cache, so writes from the tools and the REST API
+# alike clear them through `invalidate(<table>)`.
+_routes_cache = TTLCache(maxsize=8, ttl=60)
+_paths_cache = TTLCache(maxsize=128, ttl=60)
+_trips_cache = TTLCache(maxsize=8, ttl=15)
+_vehicles_cache = TTLCache(maxsize=8, ttl=60)
+_stops_cache = TTLCache(maxsize=256, ttl=60)
+register("routes", _routes_cache)
+register("paths", _paths_cache)
+register("daily_trips", _trips_cache)
+register("vehicles", _vehicles_cache)
+register("stops", _stops_cache)
+
+# Read queries return the JSON text built by Postgres (json_agg), which is handed
+# to the LLM verbatim without materializing rows in Python.
+
+@cached(_routes_cache)
+async def _fetch_routes():
+    return await fetch_json("SELECT * FROM routes")
+
+@cached(_paths_cache)
+async def _fetch_path(path_id: str):
+    return await fetch_json("SELECT * FROM paths WHERE path_id = %s", (path_id,))
+
+@cached(_trips_cache)
+async def _fetch_todays_trips():
+    # Fetch minimal fields to help the agent map Name -> ID
+    return await fetch_json(
+        "SELECT trip_id, display_name, live_status, booking_status_percentage FROM daily_trips"
+    )
+
+@cached(_vehicles_cache)
+async def _fetch_vehicles():
+    return await fetch_json("SELECT * FROM vehicles")
+
+@cached(_stops_cache, key=lambda query: hashkey(query.lower()))
+async def _search_stops(query: str):
+    # Served by the stops_name_trgm GIN index (see README); best matches first,
+    # and only the columns the agent needs to build a path.
+    return await fetch_json(
+        "SELECT stop_id, name FROM stops WHERE name ILIKE %s ORDER BY similarity(name, %s) DESC LIMIT 10",
+        (f"%{query}%", query),
+    )
 
 # --- READ TOOLS (Safe) ---
 
 @tool
-def list_all_routes():
+async def list_all_routes():
     """Call this to view all available transport routes."""
-    response = supabase.table("routes").select("*").execute()
-    return json.dumps(response.data)
+    return await _fetch_routes()
 
 @tool
-def list_stops_for_path(path_id: str):
+async def list_stops_for_path(path_id: str):
     """Get the ordered list of stops for a specific path ID."""
-    response = supabase.table("paths").select("*").eq("path_id", path_id).execute()
-    return json.dumps(response.data)
+    return await _fetch_path(path_id)
 
 @tool
-def get_trip_details(trip_id: str):
+async def get_trip_details(trip_id: str):
     """
     Get details of a specific trip, including booking status.
     Useful for checking if a trip is active or booked.
     """
-    response = supabase.table("daily_trips").select("*").eq("trip_id", trip_id).execute()
-    return json.dumps(response.data)
+    return await fetch_json("SELECT * FROM daily_trips WHERE trip_id = %s", (trip_id,))
 
 @tool
-def list_todays_trips():
+async def list_todays_trips():
     """
     Fetch all active trips for the day. 
     Returns a list containing 'trip_id', 'display_name', and 'status'.
     ALWAYS call this if you have a Name (e.g. 'Bulk - 00:01') but need the 'trip_id'.
     """
-    # Fetch minimal fields to help the agent map Name -> ID
-    response = supabase.table("daily_trips").select("trip_id, display_name, live_status, booking_status_percentage").execute()
-    return json.dumps(response.data)
+    return await _fetch_todays_trips()
 
 @tool
-def list_unassigned_vehicles():
+async def list_unassigned_vehicles():
     """
     List all vehicles (buses/cabs) with their details.
     
@@ -51,32 +102,32 @@ def list_unassigned_vehicles():
     NOTE: For this prototype we simply return all rows from the `vehicles` table.
     The agent is responsible for explaining any limitations in the answer.
     """
-    response = supabase.table("vehicles").select("*").execute()
-    return json.dumps(response.data)
+    return await _fetch_vehicles()
 
 @tool
-def search_stops(query: str):
+async def search_stops(query: str):
     """
     Search for stops by name. Useful when finding stop IDs for a path.
     Args:
         query: The name or partial name of the stop (e.g., 'Koramangala').
     """
-    response = supabase.table("stops").select("*").ilike("name", f"%{query}%").execute()
-    return json.dumps(response.data)
+    return await _search_stops(query)
 
 # --- WRITE TOOLS (Dangerous - These change data) ---
 
 @tool
-def create_new_stop(name: str, lat: float, lon: float):
+async def create_new_stop(name: str, lat: float, lon: float):
     """Create a new stop location."""
-    import uuid
-    new_id = f"stop_{str(uuid.uuid4())[:4]}"
-    data = {"stop_id": new_id, "name": name, "latitude": lat, "longitude": lon}
-    supabase.table("stops").insert(data).execute()
+    new_id = f"stop_{uuid.uuid4().hex[:8]}"
+    await execute(
+        "INSERT INTO stops (stop_id, name, latitude, longitude) VALUES (%s, %s, %s, %s)",
+        (new_id, name, lat, lon),
+    )
+    invalidate("stops")
     return f"Stop created successfully with ID: {new_id}"
 
 @tool
-def create_new_path(path_name: str, ordered_stop_ids: list[str]):
+async def create_new_path(path_name: str, ordered_stop_ids: list[str]):
     """
     Create a new path using an ordered list of existing stop IDs.
 
@@ -86,15 +137,15 @@ def create_new_path(path_name: str, ordered_stop_ids: list[str]):
 
     The LLM MUST supply valid stop IDs (call search_stops or ask the user if unsure).
     """
-    data = {
-        "path_name": path_name,
-        "ordered_list_of_stop_ids": ordered_stop_ids,
-    }
-    supabase.table("paths").insert(data).execute()
+    await execute(
+        "INSERT INTO paths (path_name, ordered_list_of_stop_ids) VALUES (%s, %s)",
+        (path_name, Jsonb(ordered_stop_ids)),
+    )
+    invalidate("paths")
     return f"Path '{path_name}' created successfully with {len(ordered_stop_ids)} stops."
 
 @tool
-def create_new_route(path_id: str, route_display_name: str, shift_time: str, direction: str):
+async def create_new_route(path_id: str, route_display_name: str, shift_time: str, direction: str):
     """
     Create a new Route (Path + Time).
     
@@ -104,101 +155,154 @@ def create_new_route(path_id: str, route_display_name: str, shift_time: str, dir
         shift_time: Time in HH:MM format (e.g., '09:00').
         direction: 'Outbound' or 'Inbound'.
     """
-    data = {
-        "path_id": path_id,
-        "route_display_name": route_display_name,
-        "shift_time": shift_time,
-        "direction": direction,
-        "status": "active",
-    }
     try:
-        response = supabase.table("routes").insert(data).execute()
-        if response.data:
+        inserted = await execute(
+            "INSERT INTO routes (path_id, route_display_name, shift_time, direction, status) "
+            "VALUES (%s, %s, %s, %s, 'active')",
+            (path_id, route_display_name, shift_time, direction),
+        )
+        if inserted:
+            invalidate("routes")
             return f"Route '{route_display_name}' created successfully."
         return "Failed to create route (no data returned)."
     except Exception as e:
         return f"Error creating route: {str(e)}"
 
 @tool
-def create_new_driver(name: str, phone_number: str):
+async def create_new_driver(name: str, phone_number: str):
     """Create a new driver in the system."""
-    import uuid
-    driver_id = f"driver_{str(uuid.uuid4())[:4]}"
-    data = {
-        "driver_id": driver_id,
-        "name": name,
-        "phone_number": phone_number
-    }
+    driver_id = f"driver_{uuid.uuid4().hex[:8]}"
     try:
-        supabase.table("drivers").insert(data).execute()
+        await execute(
+            "INSERT INTO drivers (driver_id, name, phone_number) VALUES (%s, %s, %s)",
+            (driver_id, name, phone_number),
+        )
         return f"Driver '{name}' created successfully with ID: {driver_id}"
     except Exception as e:
         return f"Error creating driver: {str(e)}"
 
 @tool
-def assign_vehicle_to_trip(trip_id: str, vehicle_id: str, driver_id: str):
+async def assign_vehicle_to_trip(trip_id: str, vehicle_id: str, driver_id: str):
     """Assign a vehicle and driver to a trip (Deploy)."""
-    import uuid
-    dep_id = f"dep_{str(uuid.uuid4())[:4]}"
-    data = {
-        "deployment_id": dep_id,
-        "trip_id": trip_id,
-        "vehicle_id": vehicle_id,
-        "driver_id": driver_id
-    }
+    dep_id = f"dep_{uuid.uuid4().hex[:8]}"
     try:
-        supabase.table("deployments").insert(data).execute()
+        await execute(
+            "INSERT INTO deployments (deployment_id, trip_id, vehicle_id, driver_id) VALUES (%s, %s, %s, %s)",
+            (dep_id, trip_id, vehicle_id, driver_id),
+        )
         # Update trip status
-        supabase.table("daily_trips").update({"live_status": "Scheduled"}).eq("trip_id", trip_id).execute()
+        await execute("UPDATE daily_trips SET live_status = 'Scheduled' WHERE trip_id = %s", (trip_id,))
+        invalidate("daily_trips")
         return "Vehicle assigned successfully."
     except Exception as e:
         return f"Error assigning vehicle: {str(e)}"
 
 @tool
-def remove_vehicle_from_trip_action(trip_id: str):
+async def remove_vehicle_from_trip_action(trip_id: str):
     """
     ACTUALLY removes the vehicle. 
     WARNING: Do not call this directly if the trip is booked.
     """
     try:
-        supabase.table("deployments").delete().eq("trip_id", trip_id).execute()
+        await execute("DELETE FROM deployments WHERE trip_id = %s", (trip_id,))
         return f"Vehicle removed from trip {trip_id}. Trip-sheet cancelled."
     except Exception as e:
         return f"Error removing vehicle: {str(e)}"
 
 @tool
-def update_trip_progress(trip_id: str, booking_percentage: int):
+async def update_trip_progress(trip_id: str, booking_percentage: int):
     """
     Update the booking percentage or progress of a trip. 
     Useful for testing consequences (e.g., 'Set occupancy of trip X to 100%').
     """
     try:
-        supabase.table("daily_trips").update({"booking_status_percentage": booking_percentage}).eq("trip_id", trip_id).execute()
+        await execute(
+            "UPDATE daily_trips SET booking_status_percentage = %s WHERE trip_id = %s",
+            (booking_percentage, trip_id),
+        )
+        invalidate("daily_trips")
         return f"Trip {trip_id} booking updated to {booking_percentage}%."
     except Exception as e:
         return f"Error updating trip: {str(e)}"
 
 # --- KNOWLEDGE TOOLS ---
 
+# Built once so every search shares one embeddings client (and its HTTP pool)
+_EMB = OpenAIEmbeddings(model="text-embedding-3-small")
+_VS = SupabaseVectorStore(
+    client=supabase,
+    embedding=_EMB,
+    table_name="documents",
+    query_name="match_documents"
+)
+
+# Semantic cache: a question close to one already answered (cosine >= 0.95)
+# reuses that answer and skips the pgvector RPC; an exact repeat also skips
+# the embedding call. Bounded FIFO, so brute-force matching stays cheap.
+_KB_CACHE_SIZE = 256
+_KB_MIN_SIMILARITY = 0.95
+_kb_exact_cache = LRUCache(maxsize=_KB_CACHE_SIZE)
+_kb_embeddings = None  # (n, dim) matrix of unit-length query embeddings
+_kb_answers = []
+
+def _kb_cache_lookup(emb):
+    if not _kb_answers:
+        return None
+    sims = _kb_embeddings @ emb
+    best = int(sims.argmax())
+    return _kb_answers[best] if sims[best] >= _KB_MIN_SIMILARITY else None
+
+def _kb_cache_store(emb, answer):
+    global _kb_embeddings
+    if _kb_embeddings is None:
+        _kb_embeddings = emb[None, :]
+    else:
+        _kb_embeddings = np.vstack([_kb_embeddings[-(_KB_CACHE_SIZE - 1):], emb])
+    _kb_answers.append(answer)
+    del _kb_answers[:-_KB_CACHE_SIZE]
+
 @tool
-def search_knowledge_base(query: str):
+async def search_knowledge_base(query: str):
     """
     Search the product documentation for help. 
     Use this when the user asks 'How do I...' or generic questions about how the system works.
     """
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-    
-    vector_store = SupabaseVectorStore(
-        client=supabase,
-        embedding=embeddings,
-        table_name="documents",
-        query_name="match_documents"
-    )
-    
-    # Search for the top 2 most relevant pieces of info
-    results = vector_store.similarity_search(query, k=2)
-    
-    if not results:
-        return "No specific documentation found."
-    
-    return "\n\n".join([doc.page_content for doc in results])
+    key = " ".join(query.lower().split())
+    if key in _kb_exact_cache:
+        return _kb_exact_cache[key]
+
+    emb = np.asarray(await _EMB.aembed_query(query), dtype=np.float32)
+    emb /= np.linalg.norm(emb)
+    answer = _kb_cache_lookup(emb)
+    if answer is None:
+        # Search for the top 2 most relevant pieces of info
+        results = await _VS.asimilarity_search_by_vector(emb.tolist(), k=2)
+        
+        if not results:
+            return "No specific documentation found."
+        
+        answer = "\n\n".join([doc.page_content for doc in results])
+        _kb_cache_store(emb, answer)
+
+    _kb_exact_cache[key] = answer
+    return answer
+
+# --- REGISTRY ---
+# Built once at import; the graph binds TOOLS to the LLM and dispatches by name.
+TOOLS = [
+    list_all_routes,
+    list_stops_for_path,
+    get_trip_details,
+    create_new_stop,
+    create_new_path,
+    create_new_route,
+    create_new_driver,
+    assign_vehicle_to_trip,
+    remove_vehicle_from_trip_action,
+    update_trip_progress,
+    search_knowledge_base,
+    list_todays_trips,
+    list_unassigned_vehicles,
+    search_stops,
+]
+TOOLS_BY_NAME = {t.name: t for t in TOOLS}
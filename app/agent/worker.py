@@ -4,49 +4,65 @@ LiveKit Voice Agent Worker with ElevenLabs TTS and Deepgram STT.
 This worker connects to LiveKit rooms and provides real-time conversational AI.
 """
 
+import warnings
+warnings.filterwarnings("ignore", category=UserWarning, module="urllib3")
+
 import asyncio
 import logging
 import os
-import sys
-import json
-from pathlib import Path
-from datetime import datetime
+import orjson
+from contextvars import ContextVar
+from typing import Optional
+from datetime import datetime, timezone
+from functools import lru_cache
 from dotenv import load_dotenv
-
-# Add project root to Python path
-project_root = Path(__file__).parent.parent.parent
-sys.path.insert(0, str(project_root))
+import httpx
+from openai import AsyncOpenAI
 
 from livekit import rtc
 from livekit.agents import (
     AutoSubscribe,
     JobContext,
+    JobProcess,
     AgentServer,
     function_tool,
 )
 from livekit.agents.voice import Agent as VoiceAgent, AgentSession
 from livekit.plugins import deepgram, elevenlabs, openai, silero
 
-# Global room reference for publishing thoughts
-_current_room = None
+# Room of the session running in the current async context, for publishing thoughts.
+# Tasks spawned by the session inherit it, so concurrent rooms never cross-post.
+_current_room: ContextVar[Optional[rtc.Room]] = ContextVar("current_room", default=None)
 
-async def publish_thought(thought_type: str, content: str, tool_name: str = None):
+@lru_cache(maxsize=256)
+def _thought_prefix(thought_type: str, content: str, tool_name: str = None) -> bytes:
+    """Encoded thought payload minus the closing brace; only the timestamp varies per send."""
+    return orjson.dumps({'type': thought_type, 'content': content, 'toolName': tool_name})[:-1]
+
+async def publish_thought(thought_type: str, content: str, tool_name: str = None, reliable: bool = True):
     """Publish agent thought process to the frontend via data channel."""
-    if _current_room:
-        try:
-            data = json.dumps({
-                'type': thought_type,
-                'content': content,
-                'toolName': tool_name,
-                'timestamp': datetime.now().isoformat()
-            })
-            await _current_room.local_participant.publish_data(
-                data.encode('utf-8'),
-                topic='agent.thoughts',
-                reliable=True
-            )
-        except Exception as e:
-            logger.error(f"Failed to publish thought: {e}")
+    room = _current_room.get()
+    if room is None:
+        return
+    timestamp = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    data = _thought_prefix(thought_type, content, tool_name) + b',"timestamp":"' + timestamp.encode() + b'"}'
+    try:
+        await room.local_participant.publish_data(
+            data,
+            topic='agent.thoughts',
+            reliable=reliable
+        )
+    except Exception as e:
+        logger.error(f"Failed to publish thought: {e}")
+
+# Strong refs so fire-and-forget publishes aren't garbage-collected mid-flight
+_pending_thoughts = set()
+
+def publish_thought_nowait(thought_type: str, content: str, tool_name: str = None):
+    """Send a best-effort (unreliable) thought without holding up the tool call."""
+    task = asyncio.create_task(publish_thought(thought_type, content, tool_name, reliable=False))
+    _pending_thoughts.add(task)
+    task.add_done_callback(_pending_thoughts.discard)
 
 # Import our existing tools
 from app.agent.tools import (
@@ -65,16 +81,55 @@ from app.agent.tools import (
     list_unassigned_vehicles,
     search_stops,
 )
+from app.core.db import pool as db_pool, VOICE_POOL_MAX_SIZE
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("movi-voice-agent")
 
+# Shared LLM: one OpenAI client (and its keep-alive connection pool) per worker
+# process, reused across every voice turn and session instead of being rebuilt
+# for each room. HTTP/2 lets concurrent completions multiplex over a single
+# TCP+TLS connection.
+HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+)
+LLM = openai.LLM(
+    model="gpt-4o-mini",
+    client=AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=HTTP),
+)
+
+# The STT/TTS clients are likewise built once per worker process, so a new
+# room does not open fresh connections. The VAD model is loaded by `prewarm`.
+# Short endpointing + interim results so the turn closes quickly after speech stops;
+# keyterms bias recognition toward our domain vocabulary.
+STT = deepgram.STT(
+    model="nova-3",
+    language="en-US",
+    smart_format=True,
+    no_delay=True,
+    numerals=True,
+    endpointing_ms=25,
+    interim_results=True,
+    keyterm=["MoveInSync", "Movi", "trip", "route", "vehicle", "stop", "path", "deployment"],
+)
+TTS = elevenlabs.TTS(
+    model="eleven_turbo_v2_5",
+    voice_id="21m00Tcm4TlvDq8ikWAM",
+    # Trade a little quality for a much earlier first audio byte
+    streaming_latency=3,
+    enable_ssml_parsing=False,
+    # Flush the first chunk after ~50 characters instead of the default ~120
+    chunk_length_schedule=[50, 90, 120, 150],
+)
+
 # Convert LangChain tools to LiveKit function tools with thought publishing
 @function_tool
 async def list_routes_tool():
     """List all active routes in the transport system."""
-    await publish_thought('tool_call', 'Fetching all active routes from database...', 'list_routes_tool')
+    publish_thought_nowait('tool_call', 'Fetching all active routes from database...', 'list_routes_tool')
     result = await list_all_routes.ainvoke({})
     await publish_thought('tool_result', f'Found {len(result) if isinstance(result, list) else "routes"} routes', 'list_routes_tool')
     return result
@@ -82,7 +137,7 @@ async def list_routes_tool():
 @function_tool
 async def list_todays_trips_tool():
     """List all trips scheduled for today."""
-    await publish_thought('tool_call', "Retrieving today's trip schedule...", 'list_todays_trips_tool')
+    publish_thought_nowait('tool_call', "Retrieving today's trip schedule...", 'list_todays_trips_tool')
     result = await list_todays_trips.ainvoke({})
     await publish_thought('tool_result', f"Retrieved today's trips successfully", 'list_todays_trips_tool')
     return result
@@ -90,7 +145,7 @@ async def list_todays_trips_tool():
 @function_tool
 async def list_unassigned_vehicles_tool():
     """List all vehicles that are not currently assigned to any trip."""
-    await publish_thought('tool_call', 'Searching for available vehicles...', 'list_unassigned_vehicles_tool')
+    publish_thought_nowait('tool_call', 'Searching for available vehicles...', 'list_unassigned_vehicles_tool')
     result = await list_unassigned_vehicles.ainvoke({})
     await publish_thought('tool_result', 'Found available vehicles in the fleet', 'list_unassigned_vehicles_tool')
     return result
@@ -164,15 +219,18 @@ Movi: "I can help with that! Which trip would you like to assign a vehicle to?"
 
 async def entrypoint(ctx: JobContext):
     """Main entrypoint for the voice agent."""
-    global _current_room
-    
     logger.info(f"🎤 Voice agent job triggered for room: {ctx.room.name}")
     
     # Connect to the room first
     await ctx.connect(auto_subscribe=AutoSubscribe.AUDIO_ONLY)
     
-    # Set global room reference for thought publishing
-    _current_room = ctx.room
+    # Bind the room for thought publishing in this session's context
+    _current_room.set(ctx.room)
+
+    # Database tools run on the async Postgres pool, shrunk to this process's share
+    # of VOICE_DB_CONNECTIONS before it opens
+    await db_pool.resize(min_size=1, max_size=VOICE_POOL_MAX_SIZE)
+    await db_pool.open()
     
     logger.info("✅ Connected to room")
 
@@ -196,13 +254,13 @@ async def entrypoint(ctx: JobContext):
 
     # Create the session with the STT, LLM, TTS components
     session = AgentSession(
-        vad=silero.VAD.load(),
-        stt=deepgram.STT(model="nova-2"),
-        llm=openai.LLM(model="gpt-4o-mini"),
-        tts=elevenlabs.TTS(
-            model="eleven_turbo_v2_5",
-            voice_id="21m00Tcm4TlvDq8ikWAM",
-        ),
+        vad=ctx.proc.userdata.get("vad") or load_vad(),
+        stt=STT,
+        llm=LLM,
+        tts=TTS,
+        # LLM tokens already stream into TTS; also start synthesis on the
+        # preemptive reply so the first audio frame is ready by end-of-turn.
+        turn_handling={"preemptive_generation": {"preemptive_tts": True}},
     )
 
     # Start the session - this returns an awaitable RunContext
@@ -212,10 +270,20 @@ async def entrypoint(ctx: JobContext):
     logger.info("✅ Voice agent is now active and listening!")
 
 
-# Create the agent server
-from livekit.agents import AgentServer
+def load_vad():
+    # Ignore blips shorter than 100 ms so noise doesn't open a user turn
+    return silero.VAD.load(min_speech_duration=0.1)
+
+def prewarm(proc: JobProcess):
+    """Load the Silero ONNX graph when the job process starts, before any room is dispatched."""
+    try:
+        proc.userdata["vad"] = load_vad()
+    except Exception as e:
+        # entrypoint falls back to loading it on demand
+        logger.error(f"VAD prewarm failed: {e}")
 
-server = AgentServer()
+# Create the agent server
+server = AgentServer(setup_fnc=prewarm)
 
 # Register the agent with explicit agent_name to disable automatic dispatch
 @server.rtc_session(agent_name="movi-voice-agent")
@@ -224,9 +292,6 @@ async def voice_agent_session(ctx: JobContext):
     await entrypoint(ctx)
 
 
-import warnings
-warnings.filterwarnings("ignore", category=UserWarning, module="urllib3")
-
 if __name__ == "__main__":
     # Start the server
     print("🚀 STARTING MOVI VOICE AGENT WORKER...")
@@ -0,0 +1,25 @@
+import asyncio
+from collections import defaultdict
+from cachetools import TTLCache
+
+# Short-TTL cache for the dashboard GET endpoints (key = table name).
+# Entries are (json_bytes, etag). Writes from the API and the agent tools call
+# `invalidate`, which also bumps the key's version so a fetch that was already
+# in flight doesn't store pre-write data.
+api_cache = TTLCache(maxsize=64, ttl=15)
+api_cache_locks = defaultdict(asyncio.Lock)
+api_cache_versions = defaultdict(int)
+
+# Other caches over the same tables (the agent tools' reads) register here, so one
+# `invalidate` call clears every cached copy of a table
+_dependents = defaultdict(list)
+
+def register(key: str, *caches):
+    _dependents[key].extend(caches)
+
+def invalidate(*keys: str):
+    for key in keys:
+        api_cache_versions[key] += 1
+        api_cache.pop(key, None)
+        for cache in _dependents.get(key, ()):
+            cache.clear()
@@ -1,11 +1,16 @@
+import asyncio
+import logging
 import os
-from supabase import create_client, Client
+from supabase import AsyncClient, Client, acreate_client, create_client
 from dotenv import load_dotenv
+from psycopg.rows import dict_row
 from psycopg_pool import AsyncConnectionPool
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY") # Must be the Service Role Key
 
@@ -15,13 +20,89 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 # 1. Standard Supabase Client (for general queries)
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# 2. Postgres Connection String (required for LangGraph Checkpointer)
-# We construct the connection string from the Supabase URL logic
-# Standard Supabase DB URL format: postgres://postgres.[project-ref]:[password]@[region].pooler.supabase.com:6543/postgres
-# BUT for the Python backend, we often use the direct connection string.
-# Let's use the direct connection string format.
-# YOU MUST UPDATE 'YOUR_DB_PASSWORD' in the function below or add DB_URI to .env
-DB_URI = os.getenv("DB_URI") 
+async def create_async_supabase() -> AsyncClient:
+    """Async client for use inside the event loop (FastAPI lifespan); awaits instead of blocking."""
+    return await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+
+# 2. Async Postgres Pool (LangGraph checkpointer + agent tools)
+# Use the direct connection string from the Supabase dashboard, e.g.
+# postgresql://postgres:<password>@db.<project>.supabase.co:5432/postgres
+DB_URI = os.getenv("DB_URI")
+
+connection_kwargs = {
+    "autocommit": True,
+    "prepare_threshold": None,  # Supabase's PgBouncer does not support prepared statements
+}
+# Sized for concurrent chats + voice sessions (per process); connections idle above
+# min_size for a minute are closed, every connection is recycled after 5 minutes (so
+# sockets silently dropped by the network don't linger), and a request waits at most
+# 10 s for a free one.
+# Supabase caps direct connections (60 on the smaller plans). VOICE_DB_CONNECTIONS of them
+# are left for the voice worker's job processes; every uvicorn worker holds its own pool,
+# so by default the rest is split across WEB_CONCURRENCY workers. Workers default to 2:
+# each one has its own pool and TTL caches, so more only pays off when the load calls
+# for it (set WEB_CONCURRENCY to opt in). The default is also capped so each worker still
+# gets AGENT_POOL_MIN connections.
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "60"))
+VOICE_DB_CONNECTIONS = int(os.getenv("VOICE_DB_CONNECTIONS", "8"))
+_API_DB_CONNECTIONS = max(1, DB_MAX_CONNECTIONS - VOICE_DB_CONNECTIONS)
+_POOL_MIN = max(1, int(os.getenv("AGENT_POOL_MIN", "4")))
+DEFAULT_WEB_CONCURRENCY = 2
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY") or max(1, min(DEFAULT_WEB_CONCURRENCY, _API_DB_CONNECTIONS // _POOL_MIN)))
+POOL_MAX_SIZE = int(os.getenv("AGENT_POOL_MAX") or max(1, min(32, _API_DB_CONNECTIONS // WEB_CONCURRENCY)))
+POOL_MIN_SIZE = min(_POOL_MIN, POOL_MAX_SIZE)
+# Voice sessions only run a handful of reads, so each job process keeps a small pool
+VOICE_POOL_MAX_SIZE = 2
+pool = AsyncConnectionPool(
+    conninfo=DB_URI,
+    min_size=POOL_MIN_SIZE,
+    max_size=POOL_MAX_SIZE,
+    max_idle=60,
+    max_lifetime=300,
+    timeout=10,
+    kwargs=connection_kwargs,
+    open=False,
+)
+POOL_CHECK_INTERVAL = 60  # seconds
+
+def check_connection_budget():
+    """Warn at startup when explicit pool settings can open more connections than Supabase allows."""
+    planned = WEB_CONCURRENCY * POOL_MAX_SIZE + VOICE_DB_CONNECTIONS
+    if planned > DB_MAX_CONNECTIONS:
+        logger.warning(
+            "Postgres pools may open %d connections (%d workers x %d + %d voice), over DB_MAX_CONNECTIONS=%d",
+            planned, WEB_CONCURRENCY, POOL_MAX_SIZE, VOICE_DB_CONNECTIONS, DB_MAX_CONNECTIONS,
+        )
+
+async def check_pool_forever(interval: float = POOL_CHECK_INTERVAL):
+    """Periodically evict broken connections so requests don't discover them first."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await pool.check()
+        except Exception as e:
+            logger.warning(f"Pool check failed: {e}")
+
+async def fetch_all(query: str, params=None):
+    """Run a query on the async pool and return rows as dicts."""
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(query, params)
+            return await cur.fetchall()
+
+async def fetch_val(query: str, params=None):
+    """Run a query on the async pool and return the first column of the first row."""
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+async def fetch_json(query: str, params=None) -> str:
+    """Run a SELECT and let Postgres serialize the rows into a JSON array string."""
+    return await fetch_val(f"SELECT coalesce(json_agg(t), '[]'::json)::text FROM ({query}) t", params)
 
-# If DB_URI isn't in .env, we try to construct it (risky if password isn't set)
-# It is BETTER to add DB_URI to your .env file.
\ No newline at end of file
+async def execute(query: str, params=None) -> int:
+    """Run a write statement on the async pool and return the affected row count."""
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        return cur.rowcount
@@ -1,31 +1,60 @@
+import asyncio
 import os
 import logging
-import base64
-from contextlib import asynccontextmanager
-from typing import List, Optional, Dict, Any
+import pybase64
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List, Literal, Optional, Dict, Any, get_args
 
-from fastapi import FastAPI, HTTPException, Form, Request, UploadFile, File
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Form, Header, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from cachetools import TTLCache
 from dotenv import load_dotenv
+import hashlib
+import hmac
+import re
+import struct
+import tempfile
+import time
+import uuid
+import weakref
 from io import BytesIO
+from PIL import Image, ImageOps
+import av
+import numpy as np
+import orjson
 
 # OpenAI Direct Client
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAioHttpClient
 
 # LiveKit Imports
-from livekit.api import AccessToken, VideoGrants, LiveKitAPI
-from livekit.protocol import room as proto_room
+from livekit.api import VideoGrants, LiveKitAPI
+from livekit.api.access_token import DEFAULT_TTL, Claims
+from livekit.protocol import agent_dispatch, room as proto_room
 
 # LangGraph Imports
-from langchain_core.messages import HumanMessage
-from app.agent.graph import init_graph, pool as agent_pool 
-from app.core.db import supabase
+from langchain_core.messages import AIMessage, HumanMessage
+from app.agent.graph import startup, get_app, pool as agent_pool
+from app.core.db import WEB_CONCURRENCY, supabase, create_async_supabase, check_pool_forever, check_connection_budget
+from app.core.cache import api_cache, api_cache_locks, api_cache_versions, invalidate
 
 # --- 1. CONFIGURATION & LOGGING ---
 load_dotenv()
 
+LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY")
+LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
+LIVEKIT_URL = os.getenv("LIVEKIT_URL")
+LIVEKIT_CONFIGURED = bool(LIVEKIT_API_KEY and LIVEKIT_API_SECRET and LIVEKIT_URL)
+
+# Frontend origins allowed to call the API (comma-separated); the Next.js dev server by default
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",") if o.strip()]
+
+# Shared secret for POST /api/cache/invalidate (sent as X-Cache-Token); unset disables it
+CACHE_ADMIN_TOKEN = os.getenv("CACHE_ADMIN_TOKEN")
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
@@ -33,41 +62,77 @@ logging.basicConfig(
 )
 logger = logging.getLogger("MoviBackend")
 
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # --- 2. LIFESPAN MANAGER ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("🚀 Movi Backend starting up...")
-    try:
-        await agent_pool.open()
-        logger.info("✅ Agent Memory Pool (Postgres) connected.")
-        
-        app.state.agent = await init_graph()
+    # One aiohttp-backed client shared by chat, transcription, TTS and vision calls;
+    # built inside the running loop so its connector belongs to it.
+    app.state.openai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=DefaultAioHttpClient())
+    # Reused by every token request for room setup and agent dispatch
+    if LIVEKIT_CONFIGURED:
+        app.state.lk_api = LiveKitAPI(LIVEKIT_URL, LIVEKIT_API_KEY, LIVEKIT_API_SECRET)
+    else:
+        app.state.lk_api = None
+        logger.warning("⚠️ LiveKit credentials not configured; /api/livekit-token is disabled.")
+    # Async PostgREST client for the API's table reads/writes; the sync client in
+    # app.core.db stays for Storage calls and the agent's vector store
+    app.state.supabase = await create_async_supabase()
+    check_connection_budget()
+    pool_check = asyncio.create_task(check_pool_forever())
+    # Warm the pool + compile the graph and ping Supabase concurrently; they are independent
+    agent_err, supabase_err = await asyncio.gather(
+        startup(),
+        # One indexed row, not an exact count (a full scan as the table grows); bounded so a
+        # hung Supabase can't stall boot
+        asyncio.wait_for(app.state.supabase.table("vehicles").select("vehicle_id").limit(1).execute(), timeout=5),
+        return_exceptions=True,
+    )
+    # Don't raise here to allow the app to start even if DB/Agent is flaky (for debugging);
+    # get_app() retries the graph build on the first request.
+    if isinstance(agent_err, Exception):
+        logger.critical("❌ Agent startup failed: %s", agent_err)
+    else:
+        logger.info("✅ Agent Memory Pool (Postgres) connected: %s", agent_pool.get_stats())
         logger.info("✅ LangGraph Agent initialized.")
-
-        supabase.table("vehicles").select("count", count="exact").execute()
+    if isinstance(supabase_err, Exception):
+        logger.critical("❌ Supabase check failed: %s", supabase_err)
+    else:
         logger.info("✅ Supabase Client connection verified.")
-        
-    except Exception as e:
-        logger.critical(f"❌ Startup failed: {e}")
-        # Don't raise e here to allow the app to start even if DB/Agent is flaky (for debugging)
-        # raise e 
     
     yield
     
     logger.info("🛑 Movi Backend shutting down...")
+    pool_check.cancel()
     await agent_pool.close()
+    await app.state.openai.close()
+    await app.state.supabase.postgrest.aclose()
+    if app.state.lk_api:
+        await app.state.lk_api.aclose()
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (bytes out, no separate encode step)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
 
-app = FastAPI(title="Movi Backend", version="1.0.0", lifespan=lifespan)
+app = FastAPI(title="Movi Backend", version="1.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
 
+# The frontend never sends cookies, so credentials stay off; together with a fixed
+# origin list that lets Starlette answer with its precomputed headers
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Content-Type", "If-None-Match"],
+    expose_headers=["ETag"],
 )
+# Dashboard JSON compresses several-fold; SSE and audio responses are left alone.
+# Level 6 gets nearly all of level 9's ratio on JSON at a fraction of the CPU.
+# Added last, so it is the outermost layer and also compresses CORS-handled responses.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 # --- 3. MODELS ---
 
@@ -113,97 +178,213 @@ class AssignDeploymentRequest(BaseModel):
 class TTSRequest(BaseModel):
     text: str
     voice: str = "nova"
+    # opus/pcm skip the server-side MP3 encode; pcm is streamed back as WAV
+    response_format: Literal["opus", "pcm", "mp3", "aac", "flac", "wav"] = "opus"
 
 class LiveKitTokenRequest(BaseModel):
     room_name: str
     participant_name: str
 
+CachedTable = Literal["routes", "paths", "vehicles", "stops"]
+CACHED_TABLES = get_args(CachedTable)
+
+class InvalidateCacheRequest(BaseModel):
+    tables: Optional[List[CachedTable]] = None  # None = every cached table
+
 # --- 4. ENDPOINTS ---
 
+# CPU-bound encode work is offloaded to a thread only for big payloads; below the
+# threshold the thread hop costs more than it saves.
+OFFLOAD_THRESHOLD = 256_000  # bytes
+_offload_stats = {"calls": 0, "threaded": 0, "inline_ns": 0, "thread_ns": 0}
+
+async def _maybe_thread(fn, *args, size: int):
+    start = time.perf_counter_ns()
+    threaded = size > OFFLOAD_THRESHOLD
+    result = await asyncio.to_thread(fn, *args) if threaded else fn(*args)
+
+    # Time the first 100 calls once so the threshold can be tuned
+    stats = _offload_stats
+    if stats["calls"] < 100:
+        stats["calls"] += 1
+        stats["threaded"] += threaded
+        stats["thread_ns" if threaded else "inline_ns"] += time.perf_counter_ns() - start
+        if stats["calls"] == 100:
+            inline = stats["calls"] - stats["threaded"]
+            logger.info(
+                "⏱️ Offload stats over 100 calls: %d inline avg %.2f ms, %d threaded avg %.2f ms",
+                inline, stats["inline_ns"] / max(inline, 1) / 1e6,
+                stats["threaded"], stats["thread_ns"] / max(stats["threaded"], 1) / 1e6,
+            )
+    return result
+
+def _estimate_json_size(rows: list) -> int:
+    return len(rows) * len(orjson.dumps(rows[0])) if rows else 0
+
+# Only the columns the dashboard reads (see movi-frontend/types), so wide or new
+# columns never travel Postgres -> PostgREST -> here -> browser for nothing
+PATH_COLUMNS = "path_id, path_name, ordered_list_of_stop_ids"
+ROUTE_COLUMNS = f"route_id, path_id, route_display_name, shift_time, direction, status, paths({PATH_COLUMNS})"
+TRIP_COLUMNS = "trip_id, route_id, display_name, booking_status_percentage, live_status, deployments(vehicle_id, driver_id)"
+VEHICLE_COLUMNS = "vehicle_id, license_plate, type, capacity"
+STOP_COLUMNS = "stop_id, name, latitude, longitude"
+
+async def _fetch(table: str, select: str):
+    """PostgREST select on the async client; awaiting it leaves the event loop free."""
+    return (await app.state.supabase.table(table).select(select).execute()).data
+
+async def _cached_body(table: str, select: str) -> tuple:
+    """Return (json_bytes, etag) for a mostly-static dashboard table from the short-TTL cache."""
+    entry = api_cache.get(table)
+    if entry is None:
+        async with api_cache_locks[table]:
+            # Concurrent misses wait for the first fetch instead of all hitting Supabase
+            entry = api_cache.get(table)
+            if entry is None:
+                version = api_cache_versions[table]
+                rows = await _fetch(table, select)
+                body = await _maybe_thread(orjson.dumps, rows, size=_estimate_json_size(rows))
+                entry = (body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"')
+                if version == api_cache_versions[table]:
+                    api_cache[table] = entry
+    return entry
+
+# Browsers revalidate every time; an unchanged table costs a 304 with no body
+CACHE_HEADERS = {"Cache-Control": "no-cache"}
+
+async def _cached_fetch(request: Request, table: str, select: str) -> Response:
+    """Serve a mostly-static dashboard table from the short-TTL cache, with an ETag."""
+    body, etag = await _cached_body(table, select)
+    headers = {"ETag": etag, **CACHE_HEADERS}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# HEALTH
+@app.get("/healthz")
+async def healthz():
+    """Liveness plus agent pool counters (pool_size, requests_waiting, ...) for sizing AGENT_POOL_*."""
+    return {"status": "ok", "agent_pool": agent_pool.get_stats()}
+
 # LIVEKIT TOKEN
+async def _ensure_room_and_agent(lk_api: LiveKitAPI, room_name: str):
+    """Create the room if needed and dispatch the voice agent unless one is already in it."""
+    try:
+        # Create the room if it doesn't exist and list its participants in one round-trip
+        created, room_info = await asyncio.gather(
+            lk_api.room.create_room(
+                proto_room.CreateRoomRequest(
+                    name=room_name,
+                )
+            ),
+            lk_api.room.list_participants(
+                proto_room.ListParticipantsRequest(room=room_name)
+            ),
+            return_exceptions=True,
+        )
+        if isinstance(created, Exception):
+            raise created
+        logger.info("✅ Created/verified room: %s", room_name)
+        
+        # Check if an agent participant is already in the room.
+        # Listing fails when the room was only just created, i.e. it is empty.
+        agent_exists = not isinstance(room_info, Exception) and any(
+            p.kind == proto_room.ParticipantInfo.Kind.AGENT 
+            for p in room_info.participants
+        )
+        
+        if not agent_exists:
+            # Dispatch the agent to the room
+            dispatch_response = await lk_api.agent_dispatch.create_dispatch(
+                agent_dispatch.CreateAgentDispatchRequest(
+                    room=room_name,
+                    agent_name="movi-voice-agent",
+                )
+            )
+            logger.info("🤖 Dispatched NEW agent to room: %s", dispatch_response)
+        else:
+            logger.info("⏭️ Agent already exists in room, skipping dispatch")
+        
+    except Exception as e:
+        logger.warning("Room/dispatch error: %s", e)
+
+# Signed tokens are valid for hours; reconnects within a few seconds reuse the same one
+_livekit_tokens: TTLCache = TTLCache(maxsize=1024, ttl=15)
+
+# The grants are the same for every participant (only the room differs), so LiveKit's
+# camelCase claim dict is built once instead of via AccessToken per token
+_VIDEO_CLAIMS = Claims(video=VideoGrants(
+    room_join=True,
+    can_publish=True,
+    can_subscribe=True,
+    can_publish_data=True,
+    room_create=True,
+)).asdict()["video"]
+_LIVEKIT_TOKEN_TTL = int(DEFAULT_TTL.total_seconds())
+
+def _livekit_jwt(room_name: str, participant_name: str) -> str:
+    key = (room_name, participant_name)
+    jwt_token = _livekit_tokens.get(key)
+    if jwt_token is None:
+        now = int(time.time())
+        jwt_token = _livekit_tokens[key] = _sign_hs256({
+            "name": participant_name,
+            "video": {**_VIDEO_CLAIMS, "room": room_name},
+            "sub": participant_name,
+            "iss": LIVEKIT_API_KEY,
+            "nbf": now,
+            "exp": now + _LIVEKIT_TOKEN_TTL,
+        })
+    return jwt_token
+
+def _b64url(data: bytes) -> bytes:
+    return pybase64.urlsafe_b64encode(data).rstrip(b"=")
+
+# Same token AccessToken.to_jwt() produces, minus PyJWT's per-call header/JSON work:
+# the header is encoded once, claims go through orjson, HMAC-SHA256 runs in OpenSSL.
+_JWT_HEADER = _b64url(b'{"alg":"HS256","typ":"JWT"}')
+# Keyed once; each token copies the prepared inner/outer state instead of re-keying
+_JWT_HMAC = hmac.new((LIVEKIT_API_SECRET or "").encode(), None, hashlib.sha256)
+
+def _sign_hs256(claims: dict) -> str:
+    signing_input = _JWT_HEADER + b"." + _b64url(orjson.dumps(claims))
+    mac = _JWT_HMAC.copy()
+    mac.update(signing_input)
+    signature = mac.digest()
+    return (signing_input + b"." + _b64url(signature)).decode("ascii")
+
 @app.post("/api/livekit-token")
-async def generate_livekit_token(req: LiveKitTokenRequest):
+async def generate_livekit_token(req: LiveKitTokenRequest, request: Request, background: BackgroundTasks):
     """Generate a LiveKit access token for voice chat and dispatch the agent."""
+    # LiveKit rejects tokens without an identity or room, but only once the browser connects
+    if not req.room_name.strip() or not req.participant_name.strip():
+        raise HTTPException(status_code=400, detail="room_name and participant_name are required")
     try:
-        api_key = os.getenv("LIVEKIT_API_KEY")
-        api_secret = os.getenv("LIVEKIT_API_SECRET")
-        livekit_url = os.getenv("LIVEKIT_URL")
-        
-        if not api_key or not api_secret or not livekit_url:
+        if not LIVEKIT_CONFIGURED:
             raise HTTPException(status_code=500, detail="LiveKit credentials not configured")
         
         # Generate user token
-        token = AccessToken(api_key, api_secret)
-        token.with_identity(req.participant_name)
-        token.with_name(req.participant_name)
+        jwt_token = _livekit_jwt(req.room_name, req.participant_name)
         
-        token.with_grants(
-            VideoGrants(
-                room_join=True,
-                room=req.room_name,
-                can_publish=True,
-                can_subscribe=True,
-                can_publish_data=True,
-                room_create=True,
-            )
-        )
-        
-        jwt_token = token.to_jwt()
+        logger.info("🎫 Generated LiveKit token for %s in room %s", req.participant_name, req.room_name)
         
-        logger.info(f"🎫 Generated LiveKit token for {req.participant_name} in room {req.room_name}")
-        
-        # Create room and dispatch agent (only if not already dispatched)
-        try:
-            lk_api = LiveKitAPI(livekit_url, api_key, api_secret)
-            
-            # Create the room if it doesn't exist
-            await lk_api.room.create_room(
-                proto_room.CreateRoomRequest(
-                    name=req.room_name,
-                )
-            )
-            logger.info(f"✅ Created/verified room: {req.room_name}")
-            
-            # Check if agent is already in the room by listing participants
-            room_info = await lk_api.room.list_participants(
-                proto_room.ListParticipantsRequest(room=req.room_name)
-            )
-            
-            # Check if an agent participant is already in the room
-            agent_exists = any(
-                p.kind == proto_room.ParticipantInfo.Kind.AGENT 
-                for p in room_info.participants
-            )
-            
-            if not agent_exists:
-                # Dispatch the agent to the room
-                from livekit.protocol import agent_dispatch
-                dispatch_response = await lk_api.agent_dispatch.create_dispatch(
-                    agent_dispatch.CreateAgentDispatchRequest(
-                        room=req.room_name,
-                        agent_name="movi-voice-agent",
-                    )
-                )
-                logger.info(f"🤖 Dispatched NEW agent to room: {dispatch_response}")
-            else:
-                logger.info(f"⏭️ Agent already exists in room, skipping dispatch")
-            
-        except Exception as e:
-            logger.warning(f"Room/dispatch error: {e}")
+        # Room setup and agent dispatch run after the response is sent, in parallel
+        # with the browser's WebRTC handshake
+        background.add_task(_ensure_room_and_agent, request.app.state.lk_api, req.room_name)
         
         return {
             "token": jwt_token,
-            "url": livekit_url,
+            "url": LIVEKIT_URL,
             "shouldConnect": True
         }
     except Exception as e:
-        logger.error(f"Error generating LiveKit token: {e}", exc_info=True)
+        logger.error("Error generating LiveKit token: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 # ROUTES
 @app.get("/api/routes")
-async def get_routes():
-    return supabase.table("routes").select("*, paths(*)").execute().data
+async def get_routes(request: Request):
+    return await _cached_fetch(request, "routes", ROUTE_COLUMNS)
 
 @app.post("/api/routes")
 async def create_route(req: CreateRouteRequest):
@@ -215,18 +396,19 @@ async def create_route(req: CreateRouteRequest):
             "direction": req.direction,
             "status": req.status,
         }
-        result = supabase.table("routes").insert(data).execute()
+        result = await app.state.supabase.table("routes").insert(data).execute()
         if not result.data:
             raise HTTPException(status_code=500, detail="Failed to create route")
+        invalidate("routes")
         return result.data[0]
     except Exception as e:
-        logger.error(f"Error creating route: {e}", exc_info=True)
+        logger.error("Error creating route: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error creating route: {str(e)}")
 
 # PATHS
 @app.get("/api/paths")
-async def get_paths():
-    return supabase.table("paths").select("*").execute().data
+async def get_paths(request: Request):
+    return await _cached_fetch(request, "paths", PATH_COLUMNS)
 
 @app.post("/api/paths")
 async def create_path(req: CreatePathRequest):
@@ -235,22 +417,26 @@ async def create_path(req: CreatePathRequest):
             "path_name": req.path_name,
             "ordered_list_of_stop_ids": req.ordered_list_of_stop_ids,
         }
-        result = supabase.table("paths").insert(data).execute()
+        result = await app.state.supabase.table("paths").insert(data).execute()
         if not result.data:
             raise HTTPException(status_code=500, detail="Failed to create path")
+        invalidate("paths")
         return result.data[0]
     except Exception as e:
-        logger.error(f"Error creating path: {e}", exc_info=True)
+        logger.error("Error creating path: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error creating path: {str(e)}")
 
 # TRIPS
 @app.get("/api/trips")
 async def get_trips():
-    return supabase.table("daily_trips").select("*, deployments(vehicle_id, driver_id)").execute().data
+    # Nested join rows can run to hundreds of KB; big payloads are encoded off the loop
+    rows = await _fetch("daily_trips", TRIP_COLUMNS)
+    body = await _maybe_thread(orjson.dumps, rows, size=_estimate_json_size(rows))
+    return Response(content=body, media_type="application/json")
 
 @app.post("/api/trips")
 async def create_trip(req: CreateTripRequest):
-    logger.info(f"Creating trip: {req.display_name}")
+    logger.info("Creating trip: %s", req.display_name)
     try:
         data = {
             "route_id": req.route_id,
@@ -258,17 +444,18 @@ async def create_trip(req: CreateTripRequest):
             "booking_status_percentage": req.booking_status_percentage,
             "live_status": req.live_status,
         }
-        result = supabase.table("daily_trips").insert(data).execute()
+        result = await app.state.supabase.table("daily_trips").insert(data).execute()
         if not result.data:
             raise HTTPException(status_code=500, detail="Failed to create trip")
+        invalidate("daily_trips")
         return result.data[0]
     except Exception as e:
-        logger.error(f"Error creating trip: {e}", exc_info=True)
+        logger.error("Error creating trip: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error creating trip: {str(e)}")
 
 @app.put("/api/trips/{trip_id}")
 async def update_trip(trip_id: str, req: UpdateTripRequest):
-    logger.info(f"Updating trip {trip_id} with {req}")
+    logger.info("Updating trip %s with %s", trip_id, req)
     try:
         update_fields: Dict[str, Any] = {}
         if req.display_name is not None:
@@ -283,49 +470,49 @@ async def update_trip(trip_id: str, req: UpdateTripRequest):
         if not update_fields:
             return {"message": "No changes provided"}
 
-        result = supabase.table("daily_trips").update(update_fields).eq("trip_id", trip_id).execute()
+        result = await app.state.supabase.table("daily_trips").update(update_fields).eq("trip_id", trip_id).execute()
         if not result.data:
             raise HTTPException(status_code=404, detail="Trip not found")
+        invalidate("daily_trips")
         return result.data[0]
     except Exception as e:
-        logger.error(f"Error updating trip: {e}", exc_info=True)
+        logger.error("Error updating trip: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error updating trip: {str(e)}")
 
 # VEHICLES & DEPLOYMENTS
 @app.get("/api/vehicles")
-async def get_vehicles():
-    return supabase.table("vehicles").select("*").execute().data
+async def get_vehicles(request: Request):
+    return await _cached_fetch(request, "vehicles", VEHICLE_COLUMNS)
 
 @app.post("/api/deployments")
 async def assign_deployment(req: AssignDeploymentRequest):
-    import uuid
     try:
-        dep_id = f"dep_{str(uuid.uuid4())[:4]}"
+        dep_id = f"dep_{uuid.uuid4().hex[:8]}"
         data = {
             "deployment_id": dep_id,
             "trip_id": req.trip_id,
             "vehicle_id": req.vehicle_id,
             "driver_id": req.driver_id,
         }
-        supabase.table("deployments").insert(data).execute()
+        await app.state.supabase.table("deployments").insert(data).execute()
         return {"message": "Deployment created", "deployment_id": dep_id}
     except Exception as e:
-        logger.error(f"Error assigning deployment: {e}", exc_info=True)
+        logger.error("Error assigning deployment: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error assigning deployment: {str(e)}")
 
 @app.delete("/api/deployments/{trip_id}")
 async def remove_deployment(trip_id: str):
     try:
-        supabase.table("deployments").delete().eq("trip_id", trip_id).execute()
+        await app.state.supabase.table("deployments").delete().eq("trip_id", trip_id).execute()
         return {"message": "Deployment removed"}
     except Exception as e:
-        logger.error(f"Error removing deployment: {e}", exc_info=True)
+        logger.error("Error removing deployment: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error removing deployment: {str(e)}")
 
 # STOPS
 @app.get("/api/stops")
-async def get_stops():
-    return supabase.table("stops").select("*").execute().data
+async def get_stops(request: Request):
+    return await _cached_fetch(request, "stops", STOP_COLUMNS)
 
 @app.post("/api/stops")
 async def create_stop(req: CreateStopRequest):
@@ -335,106 +522,528 @@ async def create_stop(req: CreateStopRequest):
             "latitude": req.latitude,
             "longitude": req.longitude,
         }
-        result = supabase.table("stops").insert(data).execute()
+        result = await app.state.supabase.table("stops").insert(data).execute()
         if not result.data:
             raise HTTPException(status_code=500, detail="Failed to create stop")
+        invalidate("stops")
         return result.data[0]
     except Exception as e:
-        logger.error(f"Error creating stop: {e}", exc_info=True)
+        logger.error("Error creating stop: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error creating stop: {str(e)}")
 
+# CACHE
+@app.post("/api/cache/invalidate")
+async def invalidate_cache(req: Optional[InvalidateCacheRequest] = None,
+                           x_cache_token: Optional[str] = Header(None)):
+    """Drop cached table reads, e.g. after editing data directly in the Supabase dashboard."""
+    if not CACHE_ADMIN_TOKEN:
+        raise HTTPException(status_code=500, detail="Cache invalidation not configured")
+    if not x_cache_token or not hmac.compare_digest(x_cache_token.encode(), CACHE_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid cache token")
+    tables = (req and req.tables) or CACHED_TABLES
+    invalidate(*tables)
+    return {"invalidated": list(tables)}
+
+# DASHBOARD
+@app.get("/api/dashboard")
+async def get_dashboard():
+    """Routes, trips, vehicles and stops in one response; the four reads run concurrently."""
+    (routes, _), trips, (vehicles, _), (stops, _) = await asyncio.gather(
+        _cached_body("routes", ROUTE_COLUMNS),
+        _fetch("daily_trips", TRIP_COLUMNS),
+        _cached_body("vehicles", VEHICLE_COLUMNS),
+        _cached_body("stops", STOP_COLUMNS),
+    )
+    # Splice the cached JSON bodies as-is instead of re-serializing them
+    trips = await _maybe_thread(orjson.dumps, trips, size=_estimate_json_size(trips))
+    body = b'{"routes":' + routes + b',"trips":' + trips + b',"vehicles":' + vehicles + b',"stops":' + stops + b"}"
+    return Response(content=body, media_type="application/json")
+
 # CHAT & AGENT
-@app.post("/api/chat")
-async def chat_endpoint(request: Request, chat_req: ChatRequest):
-    agent = request.app.state.agent
+def _sse(data: dict, event: Optional[str] = None) -> bytes:
+    frame = b"data: " + orjson.dumps(data) + b"\n\n"
+    return f"event: {event}\n".encode() + frame if event else frame
+
+class _ChatStream:
+    """Replayable SSE frame buffer: one agent run, any number of readers."""
+
+    def __init__(self):
+        self.frames: List[bytes] = []
+        self.closed = False
+        self.task: Optional[asyncio.Task] = None
+        self._cond = asyncio.Condition()
+
+    async def publish(self, frame: bytes):
+        async with self._cond:
+            self.frames.append(frame)
+            self._cond.notify_all()
+
+    async def close(self):
+        async with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    async def subscribe(self):
+        sent = 0
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: sent < len(self.frames) or self.closed)
+                batch, done = self.frames[sent:], self.closed
+            sent += len(batch)
+            for frame in batch:
+                yield frame
+            if done:
+                return
+
+# Identical (message, thread_id, current_page) requests already running share one
+# agent run; late joiners replay the frames sent so far, then follow live. A thread's
+# latest finished run stays replayable for a few seconds so a double-tapped send isn't
+# run twice, but only until another turn starts on that thread: after that, the same
+# message ("show trips", "yes") must run again against the new state.
+_inflight: Dict[tuple, _ChatStream] = {}
+_recent: TTLCache = TTLCache(maxsize=256, ttl=5)  # thread_id -> (key, stream)
+_last_turn: TTLCache = TTLCache(maxsize=1024, ttl=300)  # thread_id -> latest started stream
+
+def _start_turn(thread_id: str, stream: _ChatStream):
+    _recent.pop(thread_id, None)
+    _last_turn[thread_id] = stream
+
+def _replayable(key: tuple, thread_id: str) -> Optional[_ChatStream]:
+    recent = _recent.get(thread_id)
+    return recent[1] if recent and recent[0] == key else None
+
+def _finish_chat(key: tuple, thread_id: str, stream: _ChatStream):
+    _inflight.pop(key, None)
+    if _last_turn.get(thread_id) is stream:
+        _recent[thread_id] = (key, stream)
+
+# One agent run at a time per thread, so a session's checkpoint writes never interleave.
+# Weak values: a thread's lock disappears once no request is holding or waiting on it.
+_thread_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _thread_lock(thread_id: str) -> asyncio.Lock:
+    lock = _thread_locks.get(thread_id)
+    if lock is None:
+        lock = _thread_locks[thread_id] = asyncio.Lock()
+    return lock
+
+# Only unmistakable chit-chat (a message made up entirely of greetings, thanks and short
+# acknowledgements) is answered directly, with the thread's last few messages for
+# context; anything else — trip names, plates, bare stop names — goes to the agent,
+# as does every reply while a confirmation is pending.
+_SMALL_TALK_WORDS = frozenset(
+    "hi hello hey hiya yo good morning afternoon evening night there movi "
+    "thanks thank thx ty cheers you so much a lot very "
+    "ok okay k sure cool great nice awesome perfect got it noted "
+    "bye goodbye see ya later how are who what's up".split()
+)
+_SMALL_TALK_MAX_WORDS = 6
+
+SMALL_TALK_PROMPT = (
+    "You are 'Movi', a friendly transport manager assistant. "
+    "Reply briefly. If the user wants to see or change transport data, ask what they need."
+)
+SMALL_TALK_HISTORY = 6  # messages
+
+def _is_small_talk(message: str) -> bool:
+    words = re.findall(r"[\w']+", message.lower())
+    return 0 < len(words) <= _SMALL_TALK_MAX_WORDS and _SMALL_TALK_WORDS.issuperset(words)
+
+async def _stream_agent(message: str, current_page: str, stream: _ChatStream, config: dict) -> bool:
+    agent = await get_app()
+    inputs = {
+        "messages": [HumanMessage(content=message)],
+        "current_page": current_page,
+    }
+    last_id = None
+    async for msg, _ in agent.astream(inputs, config=config, stream_mode="messages"):
+        if not isinstance(msg, AIMessage) or not isinstance(msg.content, str) or not msg.content:
+            continue
+        if last_id is not None and msg.id != last_id:
+            # A new assistant message (e.g. after a tool round) starts a new paragraph
+            await stream.publish(_sse({"delta": "\n\n"}))
+        last_id = msg.id
+        await stream.publish(_sse({"delta": msg.content}))
+    state = await agent.aget_state(config)
+    return state.values.get("awaiting_confirmation", False)
+
+def _small_talk_history(messages: list) -> List[dict]:
+    # Only the visible conversation; tool calls and their results stay with the agent
+    history = []
+    for msg in messages:
+        if isinstance(msg, HumanMessage) and isinstance(msg.content, str):
+            history.append({"role": "user", "content": msg.content})
+        elif (isinstance(msg, AIMessage) and not msg.tool_calls
+              and isinstance(msg.content, str) and msg.content):
+            history.append({"role": "assistant", "content": msg.content})
+    return history[-SMALL_TALK_HISTORY:]
+
+async def _stream_small_talk(chat_req: ChatRequest, history: List[dict], stream: _ChatStream,
+                             openai_client: AsyncOpenAI) -> str:
+    completion = await openai_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": SMALL_TALK_PROMPT},
+            *history,
+            {"role": "user", "content": chat_req.message},
+        ],
+        stream=True,
+    )
+    parts = []
+    async for chunk in completion:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            await stream.publish(_sse({"delta": parts[-1]}))
+    return "".join(parts)
+
+async def _run_chat(chat_req: ChatRequest, stream: _ChatStream, openai_client: AsyncOpenAI):
+    async with _thread_lock(chat_req.thread_id):
+        await _run_chat_turn(chat_req, stream, openai_client)
+
+async def _run_chat_turn(chat_req: ChatRequest, stream: _ChatStream, openai_client: AsyncOpenAI):
+    config = {"configurable": {"thread_id": chat_req.thread_id}}
+    awaiting_confirmation = False
+    small_talk = None
     try:
-        logger.info(f"💬 Chat: {chat_req.message}")
-        config = {"configurable": {"thread_id": chat_req.thread_id}}
-        inputs = {
-            "messages": [HumanMessage(content=chat_req.message)],
-            "current_page": chat_req.current_page,
-        }
-        final_state = await agent.ainvoke(inputs, config=config)
-        return {
-            "response": final_state["messages"][-1].content,
-            "awaiting_confirmation": final_state.get("awaiting_confirmation", False),
-        }
+        agent = await get_app()
+        thread_state = None
+        if _is_small_talk(chat_req.message):
+            # Only chit-chat pays for this checkpoint read; it supplies both the pending
+            # confirmation check and the history. Agent turns load the checkpoint themselves.
+            thread_state = (await agent.aget_state(config)).values
+        if thread_state is None or thread_state.get("awaiting_confirmation"):
+            awaiting_confirmation = await _stream_agent(chat_req.message, chat_req.current_page, stream, config)
+        else:
+            history = _small_talk_history(thread_state.get("messages", []))
+            small_talk = await _stream_small_talk(chat_req, history, stream, openai_client)
     except Exception as e:
-        logger.error(f"Agent error: {e}", exc_info=True)
+        logger.error("Agent error: %s", e, exc_info=True)
         # Fallback
-        return {
-            "response": f"I'm having trouble connecting to my brain right now. Error: {str(e)}",
-            "awaiting_confirmation": False
-        }
+        await stream.publish(_sse({"delta": f"I'm having trouble connecting to my brain right now. Error: {str(e)}"}))
+    finally:
+        await stream.publish(_sse({"awaiting_confirmation": awaiting_confirmation}, event="done"))
+        await stream.close()
+
+    if small_talk:
+        # Record the exchange in the thread after the reply is out, so the agent keeps the context
+        try:
+            await agent.aupdate_state(
+                config,
+                {"messages": [HumanMessage(content=chat_req.message), AIMessage(content=small_talk)]},
+                as_node="agent",
+            )
+        except Exception as e:
+            logger.warning("Could not record small talk in thread %s: %s", chat_req.thread_id, e)
+
+@app.post("/api/chat")
+async def chat_endpoint(chat_req: ChatRequest, request: Request):
+    """Stream the agent reply as Server-Sent Events: `delta` frames, then one `done` frame."""
+    key = (chat_req.message, chat_req.thread_id, chat_req.current_page)
+    stream = _inflight.get(key) or _replayable(key, chat_req.thread_id)
+    if stream is None:
+        logger.info("💬 Chat: %s", chat_req.message)
+        stream = _ChatStream()
+        _inflight[key] = stream
+        _start_turn(chat_req.thread_id, stream)
+        # Runs as its own task so a disconnecting client never cancels the shared run
+        stream.task = asyncio.create_task(_run_chat(chat_req, stream, request.app.state.openai))
+        stream.task.add_done_callback(lambda _: _finish_chat(key, chat_req.thread_id, stream))
+    else:
+        logger.info("💬 Chat (coalesced): %s", chat_req.message)
+    return StreamingResponse(
+        stream.subscribe(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))  # OpenAI's audio file limit
+VAD_FRAME_SAMPLES = 480  # 30 ms at 16 kHz
+VAD_RMS_THRESHOLD = 0.01  # ~ -40 dBFS
+MIN_VOICED_MS = 100
+PROMPT_TAIL_CHARS = 500
+
+def _voiced_ms(audio_file) -> Optional[float]:
+    """
+    Decode to 16 kHz mono PCM and count the milliseconds of 30 ms frames above the
+    energy threshold. Returns None if the container can't be decoded locally.
+    """
+    try:
+        audio_file.seek(0)
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=16000)
+        chunks = []
+        with av.open(audio_file, mode="r") as container:
+            for frame in container.decode(audio=0):
+                chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(frame))
+            chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(None))
+    except Exception as e:
+        logger.warning("Local VAD skipped: %s", e)
+        return None
+    finally:
+        audio_file.seek(0)
+
+    if not chunks:
+        return 0.0
+    pcm = np.concatenate(chunks).astype(np.float32) / 32768.0
+    n_frames = len(pcm) // VAD_FRAME_SAMPLES
+    frames = pcm[: n_frames * VAD_FRAME_SAMPLES].reshape(n_frames, VAD_FRAME_SAMPLES)
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    return float(np.count_nonzero(rms > VAD_RMS_THRESHOLD) * 30)
 
 @app.post("/api/transcribe")
-async def transcribe_audio(audio: UploadFile = File(...)):
+async def transcribe_audio(
+    request: Request,
+    audio: UploadFile = File(...),
+    prompt: Optional[str] = Form(None),  # confirmed transcript of the previous clip(s)
+):
+    """
+    Stream the transcript as Server-Sent Events (`delta` frames, then `event: done`).
+    Too-short or silent clips get a lone `done` frame with an empty transcript, without
+    calling OpenAI, so callers handle a single response type.
+    Clients sending consecutive clips can pass the text confirmed so far as `prompt`;
+    its tail conditions the model so words split across clips are decoded consistently.
+    """
+    audio_file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
     try:
-        audio_bytes = await audio.read()
-        if len(audio_bytes) < 100:
-            return {"text": "Audio too short."}
-        
-        audio_file = BytesIO(audio_bytes)
-        audio_file.name = "audio.webm" # Simple default
-        
-        transcript = await openai_client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            response_format="text",
+        size = 0
+        while chunk := await audio.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Audio upload too large")
+            audio_file.write(chunk)
+        voiced_ms = await asyncio.to_thread(_voiced_ms, audio_file) if size >= 100 else 0
+        if voiced_ms is not None and voiced_ms < MIN_VOICED_MS:
+            audio_file.close()
+            return StreamingResponse(
+                iter([_sse({"text": ""}, event="done")]),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache"},
+            )
+
+        stream = await request.app.state.openai.audio.transcriptions.create(
+            model="gpt-4o-mini-transcribe",
+            file=(audio.filename or "audio.webm", audio_file),
             language="en",
+            stream=True,
+            **({"prompt": prompt[-PROMPT_TAIL_CHARS:]} if prompt else {}),
         )
-        return {"text": transcript}
+    except HTTPException:
+        audio_file.close()
+        raise
     except Exception as e:
-        logger.error(f"Transcription error: {e}", exc_info=True)
+        audio_file.close()
+        logger.error("Transcription error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+    async def events():
+        try:
+            async for event in stream:
+                if event.type == "transcript.text.delta":
+                    yield _sse({"delta": event.delta})
+                elif event.type == "transcript.text.done":
+                    yield _sse({"text": event.text}, event="done")
+        except Exception as e:
+            logger.error("Transcription error: %s", e, exc_info=True)
+            yield _sse({"detail": str(e)}, event="error")
+        finally:
+            audio_file.close()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# MEDIA CACHE
+# Optional Supabase Storage bucket holding Vision intents and TTS audio, keyed by a hash
+# of everything that determines the output, so repeated screenshots and phrases skip OpenAI.
+MEDIA_CACHE_BUCKET = os.getenv("MEDIA_CACHE_BUCKET")
+
+def _media_cache_key(*parts: bytes) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+def _media_cache_get(path: str) -> Optional[bytes]:
+    try:
+        return supabase.storage.from_(MEDIA_CACHE_BUCKET).download(path)
+    except Exception:
+        return None  # not cached yet (or Storage unavailable)
+
+def _media_cache_put(path: str, data: bytes, mime_type: str):
+    try:
+        supabase.storage.from_(MEDIA_CACHE_BUCKET).upload(path, data, {"content-type": mime_type, "upsert": "true"})
+    except Exception as e:
+        logger.warning("Media cache store failed for %s: %s", path, e)
+
+TTS_MODEL = os.getenv("TTS_MODEL", "gpt-4o-mini-tts")
+TTS_MEDIA_TYPES = {
+    "opus": "audio/ogg",
+    "pcm": "audio/wav",
+    "mp3": "audio/mpeg",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+}
+
+def _streaming_wav_header(sample_rate: int = 24000, channels: int = 1, bits: int = 16) -> bytes:
+    """RIFF header for OpenAI's raw PCM (24 kHz, 16-bit, mono) with open-ended sizes, since the length isn't known up front."""
+    block_align = channels * bits // 8
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
 @app.post("/api/text-to-speech")
-async def text_to_speech(req: TTSRequest):
+async def text_to_speech(req: TTSRequest, request: Request):
+    media_type = TTS_MEDIA_TYPES[req.response_format]
+    cache_path = None
+    if MEDIA_CACHE_BUCKET:
+        key = _media_cache_key(TTS_MODEL.encode(), req.voice.encode(), req.response_format.encode(), req.text.encode())
+        cache_path = f"tts/{key}.{req.response_format}"
+        cached = await asyncio.to_thread(_media_cache_get, cache_path)
+        if cached:
+            return Response(content=cached, media_type=media_type)
+
+    # Enter the streaming context before responding so API errors still surface as a 500;
+    # the generator below keeps it open until the last chunk has been forwarded.
+    stack = AsyncExitStack()
     try:
-        response = await openai_client.audio.speech.create(
-            model="tts-1",
-            voice=req.voice,
-            input=req.text,
-            response_format="mp3"
+        response = await stack.enter_async_context(
+            request.app.state.openai.audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=req.voice,
+                input=req.text,
+                response_format=req.response_format
+            )
         )
-        return StreamingResponse(iter([response.content]), media_type="audio/mpeg")
     except Exception as e:
-        logger.error(f"TTS error: {e}", exc_info=True)
+        await stack.aclose()
+        logger.error("TTS error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/analyze-image")
-async def analyze_image(
-    request: Request,
-    image: UploadFile = File(...),
-    thread_id: str = Form(...),
-    current_page: str = Form(...),
-    message: Optional[str] = Form(None) # Added optional message field
-):
-    agent = request.app.state.agent
-    logger.info(f"👁️ Analyzing Uploaded File: {image.filename}. Message: {message}")
-    
-    try:
-        file_bytes = await image.read()
-        
-        mime_type = "image/jpeg"
-        if image.filename.lower().endswith(".png"):
-            mime_type = "image/png"
-        elif image.filename.lower().endswith(".webp"):
-            mime_type = "image/webp"
-            
-        base64_image = base64.b64encode(file_bytes).decode("utf-8")
-        image_url_data = f"data:{mime_type};base64,{base64_image}"
+    sent: List[bytes] = []
+    finished = False
 
-        # Construct prompt based on user message
-        user_prompt = "Describe what action this screenshot implies for a transport manager."
-        if message:
-            user_prompt = f"The user says: '{message}'. Based on this image and the user's message, return a single command sentence that the Movi agent can execute."
+    async def audio_chunks():
+        nonlocal finished
+        async with stack:
+            if req.response_format == "pcm":
+                sent.append(_streaming_wav_header())
+                yield sent[-1]
+            async for chunk in response.iter_bytes(chunk_size=4096):
+                if cache_path:
+                    sent.append(chunk)
+                yield chunk
+        finished = True
+
+    def store():
+        # Runs after the response is sent; a cut-off stream is never cached
+        if cache_path and finished:
+            _media_cache_put(cache_path, b"".join(sent), media_type)
+
+    return StreamingResponse(audio_chunks(), media_type=media_type, background=BackgroundTask(store))
+
+# A sentence ends at . ! or ? followed by a capitalized word, unless the dot closes an
+# abbreviation or initial common in stop names ("St. Mark's Road", "Dr. Rajkumar Rd")
+_SENTENCE_END = re.compile(r"(\w*)[.!?]\s+(?=[A-Z])")
+_ABBREVIATIONS = {"st", "dr", "rd", "mr", "mrs", "ms", "jr", "sr", "no", "nr", "ave", "blvd", "opp", "vs", "etc"}
+
+def _first_sentence(text: str) -> Optional[str]:
+    """The first complete sentence of a streamed completion, once a second one has begun."""
+    for match in _SENTENCE_END.finditer(text):
+        word = match.group(1)
+        if text[match.end(1)] == "." and (len(word) == 1 or word.lower() in _ABBREVIATIONS):
+            continue
+        return text[:match.end(1) + 1].strip()
+    return None
+
+# Vision declining the image ("I'm sorry, I can't ...") gives the agent nothing to act on
+_VISION_REFUSAL = re.compile(r"^\W*(i'?m sorry|sorry|i(?:'m| am) unable|i (?:cannot|can't|can not))\b", re.I)
+VISION_UNREADABLE_REPLY = "I couldn't interpret that image. Could you describe what you'd like to do?"
+
+def _is_actionable(intent: str) -> bool:
+    return bool(intent) and not _VISION_REFUSAL.match(intent)
+
+# OpenAI's high-detail pass fits images within 2048x2048 and then scales the short
+# side down to 768; doing the same here shrinks the upload without changing what it sees
+MAX_VISION_SIDE = 2048
+MAX_VISION_SHORT_SIDE = 768
+_PIL_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+
+# Supabase Storage bucket for vision uploads. When set, gpt-4o fetches the image from a
+# short-lived signed URL instead of receiving it base64-inlined in the request body.
+VISION_BUCKET = os.getenv("VISION_BUCKET")
+VISION_URL_TTL = 300  # seconds
+_IMAGE_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+_IMAGE_MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+# In-process front of the Storage media cache: (image, prompt) hash -> interpreted intent
+_vision_intents: TTLCache = TTLCache(maxsize=512, ttl=3600)
+
+def _prepare_image(image_file, mime_type: str) -> bytes:
+    """Return the upload's bytes, upright and downscaled to the size OpenAI's high-detail pass would use."""
+    image_file.seek(0)
+    try:
+        img = Image.open(image_file)
+        # Phone photos are stored sideways with an EXIF Orientation tag, which the
+        # re-encode would drop; rotate the pixels instead so gpt-4o sees them upright
+        oriented = img.getexif().get(0x0112, 1) != 1
+        if oriented:
+            img = ImageOps.exif_transpose(img)
+        scale = min(MAX_VISION_SIDE / max(img.size), MAX_VISION_SHORT_SIDE / min(img.size))
+        if scale < 1 or oriented:
+            if scale < 1:
+                img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+            if mime_type == "image/jpeg" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            buf = BytesIO()
+            img.save(buf, format=_PIL_FORMATS[mime_type], quality=85)
+            file_bytes = buf.getvalue()
         else:
-            user_prompt += " Return a single command sentence."
+            image_file.seek(0)
+            file_bytes = image_file.read()
+    except Exception as e:
+        # Not decodable locally: send the original bytes and let OpenAI judge
+        logger.warning("Image resize skipped: %s", e)
+        image_file.seek(0)
+        file_bytes = image_file.read()
+    return file_bytes
 
-        logger.info(f"📨 Sending {mime_type} image to OpenAI Vision with prompt: {user_prompt}")
-        
-        response = await openai_client.chat.completions.create(
+def _image_data_url(file_bytes: bytes, mime_type: str) -> str:
+    # Assemble as bytes and decode once, instead of building an intermediate base64 str;
+    # pybase64 uses SIMD encoders, several times faster than the stdlib on image-sized input
+    return (b"data:" + mime_type.encode() + b";base64," + pybase64.b64encode(file_bytes)).decode("ascii")
+
+def _upload_for_vision(file_bytes: bytes, mime_type: str) -> tuple:
+    """Upload to VISION_BUCKET and return (path, signed URL the Vision API can fetch)."""
+    path = f"uploads/{uuid.uuid4().hex}{_IMAGE_EXTENSIONS.get(mime_type, '')}"
+    bucket = supabase.storage.from_(VISION_BUCKET)
+    bucket.upload(path, file_bytes, {"content-type": mime_type})
+    return path, bucket.create_signed_url(path, VISION_URL_TTL)["signedURL"]
+
+def _remove_vision_upload(path: str):
+    # Uploads are single-use; drop them once OpenAI has read the image
+    try:
+        supabase.storage.from_(VISION_BUCKET).remove([path])
+    except Exception as e:
+        logger.warning("Could not remove vision upload %s: %s", path, e)
+
+async def _start_vision(openai_client: AsyncOpenAI, file_bytes: bytes, mime_type: str, user_prompt: str):
+    """
+    Hand the image to gpt-4o (signed Storage URL when configured, else inline) and open
+    the stream. Returns (stream, Storage path to remove once the stream is consumed).
+    """
+    image_url_data = upload_path = None
+    if VISION_BUCKET:
+        try:
+            upload_path, image_url_data = await asyncio.to_thread(_upload_for_vision, file_bytes, mime_type)
+        except Exception as e:
+            logger.warning("Vision upload to storage failed, inlining image: %s", e)
+    if image_url_data is None:
+        image_url_data = await _maybe_thread(_image_data_url, file_bytes, mime_type, size=len(file_bytes))
+
+    logger.info("📨 Sending %s image to OpenAI Vision with prompt: %s", mime_type, user_prompt)
+    try:
+        stream = await openai_client.chat.completions.create(
             model="gpt-4o",
             messages=[
                 {
@@ -459,26 +1068,161 @@ async def analyze_image(
                 }
             ],
             max_tokens=300,
+            stream=True,
         )
-        
-        interpreted_intent = response.choices[0].message.content
-        logger.info(f"🧠 Vision Result: {interpreted_intent}")
-        
+    except Exception:
+        if upload_path:
+            await asyncio.to_thread(_remove_vision_upload, upload_path)
+        raise
+    return stream, upload_path
+
+@app.post("/api/analyze-image")
+async def analyze_image(
+    request: Request,
+    image: UploadFile = File(...),
+    thread_id: str = Form(...),
+    current_page: str = Form(...),
+    message: Optional[str] = Form(None) # Added optional message field
+):
+    """
+    Stream the result as Server-Sent Events: agent `delta` frames, an `intent` frame
+    with the Vision interpretation, then one `done` frame (or `event: error`).
+    """
+    if image.size is not None and image.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Image upload too large")
+    agent = await get_app()
+    logger.info("👁️ Analyzing Uploaded File: %s. Message: %s", image.filename, message)
+    
+    state_task = None
+    try:
+        # Trust the browser's declared type when it's one we handle; else go by extension
+        mime_type = image.content_type
+        if mime_type not in _PIL_FORMATS:
+            ext = os.path.splitext((image.filename or "").lower())[1]
+            mime_type = _IMAGE_MIME_TYPES.get(ext, "image/jpeg")
+
+        # Decode/resize/base64 are CPU-bound; keep large uploads off the event loop
+        file_bytes = await _maybe_thread(
+            _prepare_image, image.file, mime_type,
+            size=image.size if image.size is not None else OFFLOAD_THRESHOLD + 1,
+        )
+
+        # Construct prompt based on user message
+        user_prompt = "Describe what action this screenshot implies for a transport manager."
+        if message:
+            user_prompt = f"The user says: '{message}'. Based on this image and the user's message, return a single command sentence that the Movi agent can execute."
+        else:
+            user_prompt += " Return a single command sentence."
+
+        # Only the interpretation is cached; the agent reply depends on the thread's state
+        intent_key = _media_cache_key(file_bytes, user_prompt.encode())
+        cache_path = f"vision/{intent_key}.txt" if MEDIA_CACHE_BUCKET else None
+        cached_intent = _vision_intents.get(intent_key)
+        if cached_intent is None and cache_path:
+            cached = await asyncio.to_thread(_media_cache_get, cache_path)
+            if cached:
+                cached_intent = _vision_intents[intent_key] = cached.decode()
+
         config = {"configurable": {"thread_id": thread_id}}
-        inputs = {
-            "messages": [HumanMessage(content=interpreted_intent)],
-            "current_page": current_page
-        }
-        
-        final_state = await agent.ainvoke(inputs, config=config)
-        return {
-            "interpreted_intent": interpreted_intent,
-            "response": final_state["messages"][-1].content
-        }
+        # Restore the thread's checkpoint while Vision is still generating
+        state_task = asyncio.create_task(agent.aget_state(config))
+
+        events = _ChatStream()
+        # A vision turn also moves the thread on, so earlier text replies stop replaying
+        _start_turn(thread_id, events)
+
+        async def run_agent(intent: str) -> bool:
+            async with _thread_lock(thread_id):
+                await state_task
+                return await _stream_agent(intent, current_page, events, config)
+
+        stream = upload_path = None
+        if cached_intent is None:
+            stream, upload_path = await _start_vision(request.app.state.openai, file_bytes, mime_type, user_prompt)
     except Exception as e:
-        logger.error(f"🔥 Vision Crash: {e}", exc_info=True)
+        logger.error("🔥 Vision Crash: %s", e, exc_info=True)
+        if state_task is not None:
+            state_task.cancel()
         raise HTTPException(status_code=500, detail=f"Vision Error: {str(e)}")
 
+    async def run_vision():
+        # The prompt asks for a single command sentence, so the agent starts on the
+        # first complete sentence instead of waiting for the whole completion. When
+        # Vision says more than that (e.g. the trip name in a later sentence), the rest
+        # follows as a second turn on the thread; the full text is what gets cached.
+        agent_task = None
+        agent_input = None
+        parts = []
+        fresh_intent = None
+        try:
+            if stream is None:
+                interpreted_intent = cached_intent
+                logger.info("🧠 Vision Result (cached): %s", interpreted_intent)
+            else:
+                async for chunk in stream:
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    parts.append(chunk.choices[0].delta.content)
+                    if agent_task is None:
+                        sentence = _first_sentence("".join(parts))
+                        if sentence and _is_actionable(sentence):
+                            agent_input = sentence
+                            agent_task = asyncio.create_task(run_agent(agent_input))
+
+                interpreted_intent = "".join(parts).strip()
+                logger.info("🧠 Vision Result: %s", interpreted_intent)
+                if _is_actionable(interpreted_intent):
+                    fresh_intent = _vision_intents[intent_key] = interpreted_intent
+            await events.publish(_sse({"interpreted_intent": interpreted_intent}, event="intent"))
+            if agent_task is None and not _is_actionable(interpreted_intent):
+                # Empty or refused: skip the graph run (and its DB reads) entirely
+                await events.publish(_sse({"delta": VISION_UNREADABLE_REPLY}))
+                awaiting_confirmation = False
+            else:
+                if agent_task is None:
+                    agent_task = asyncio.create_task(run_agent(interpreted_intent))
+                awaiting_confirmation = await agent_task
+                remainder = interpreted_intent[len(agent_input):].strip() if agent_input else ""
+                if remainder:
+                    await events.publish(_sse({"delta": "\n\n"}))
+                    awaiting_confirmation = await run_agent(remainder)
+            await events.publish(_sse({
+                "interpreted_intent": interpreted_intent,
+                "awaiting_confirmation": awaiting_confirmation,
+            }, event="done"))
+        except Exception as e:
+            logger.error("🔥 Vision Crash: %s", e, exc_info=True)
+            if agent_task is not None and not agent_task.done():
+                # The agent may already have called a write tool; let its turn finish
+                # rather than cutting it off because the Vision stream failed
+                await asyncio.wait([agent_task])
+            await events.publish(_sse({"detail": f"Vision Error: {str(e)}"}, event="error"))
+        finally:
+            if agent_task is None and not state_task.done():
+                state_task.cancel()
+            await events.close()
+        if upload_path:
+            await asyncio.to_thread(_remove_vision_upload, upload_path)
+        if cache_path and fresh_intent:
+            await asyncio.to_thread(_media_cache_put, cache_path, fresh_intent.encode(), "text/plain")
+
+    # Runs as its own task so a disconnecting client never cancels the agent mid-turn
+    events.task = asyncio.create_task(run_vision())
+    return StreamingResponse(
+        events.subscribe(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker process runs its own lifespan (pool, compiled graph, caches)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY,  # app.core.db sizes each worker's pool from the same value
+        log_level="info",
+    )
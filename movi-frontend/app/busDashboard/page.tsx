@@ -1,7 +1,7 @@
 "use client";
 
 import { useEffect, useMemo, useState } from "react";
-import { fetchTrips, fetchRoutes, fetchVehicles, fetchStops, createTrip, assignDeployment, removeDeployment } from "@/lib/api";
+import { fetchDashboard, createTrip, assignDeployment, removeDeployment } from "@/lib/api";
 import { Trip, Route, Vehicle, Stop } from "@/types";
 import MoviWidget from "@/components/MoviWidget";
 import dynamic from "next/dynamic";
@@ -33,12 +33,7 @@ export default function BusDashboard() {
   const loadData = async () => {
     try {
       setLoading(true);
-      const data = await fetchTrips();
-      const [routesData, vehiclesData, stopsData] = await Promise.all([
-        fetchRoutes(),
-        fetchVehicles(),
-        fetchStops(),
-      ]);
+      const { trips: data, routes: routesData, vehicles: vehiclesData, stops: stopsData } = await fetchDashboard();
       setRoutes(routesData);
       setVehicles(vehiclesData);
       setStops(stopsData);
@@ -48,22 +48,35 @@ export default function MoviWidget({ currentPage }: MoviWidgetProps) {
 
     try {
       let responseData;
+
+      // Render the reply as it streams in
+      const timestamp = Date.now();
+      let started = false;
+      const onDelta = (text: string) => {
+        const aiMsg: ChatMessage = { role: "assistant", content: text, timestamp };
+        if (!started) {
+          started = true;
+          setIsTyping(false);
+          setMessages((prev) => [...prev, aiMsg]);
+        } else {
+          setMessages((prev) => [...prev.slice(0, -1), aiMsg]);
+        }
+      };
       
       if (selectedImage) {
         // Use vision endpoint if image is present
-        responseData = await uploadImageAnalysis(selectedImage, threadId, currentPage, currentInput);
+        responseData = await uploadImageAnalysis(selectedImage, threadId, currentPage, currentInput, onDelta);
         
         // Clear image state after sending
         setSelectedImage(null);
         setImagePreview(null);
         if (fileInputRef.current) fileInputRef.current.value = "";
       } else {
-        // Regular chat
-        responseData = await sendChatMessage(currentInput, threadId, currentPage);
+        responseData = await sendChatMessage(currentInput, threadId, currentPage, onDelta);
+      }
+      if (!started) {
+        setMessages((prev) => [...prev, { role: "assistant", content: responseData.response, timestamp }]);
       }
-
-      const aiMsg: ChatMessage = { role: "assistant", content: responseData.response, timestamp: Date.now() };
-      setMessages((prev) => [...prev, aiMsg]);
       
       if (responseData.awaiting_confirmation) {
         // Handle confirmation flow
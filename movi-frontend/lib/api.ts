@@ -30,6 +30,13 @@ export async function fetchStops() {
   return res.json();
 }
 
+// Routes, trips, vehicles and stops in one request (fetched concurrently server-side)
+export async function fetchDashboard() {
+  const res = await fetch(`${BACKEND_URL}/dashboard`);
+  if (!res.ok) throw new Error("Failed to fetch dashboard");
+  return res.json();
+}
+
 export async function createStop(payload: {
   name: string;
   latitude: number;
@@ -149,7 +156,13 @@ export async function removeDeployment(trip_id: string) {
   return res.json();
 }
 
-export async function sendChatMessage(message: string, threadId: string, currentPage: string) {
+// /chat streams Server-Sent Events: `data: {"delta": ...}` frames, then `event: done`.
+export async function sendChatMessage(
+  message: string,
+  threadId: string,
+  currentPage: string,
+  onDelta?: (text: string) => void
+) {
   const res = await fetch(`${BACKEND_URL}/chat`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
@@ -159,10 +172,61 @@ export async function sendChatMessage(message: string, threadId: string, current
       current_page: currentPage 
     }),
   });
-  return res.json();
+  if (!res.ok || !res.body) throw new Error("Failed to send chat message");
+  return readAgentStream(res.body, onDelta);
 }
 
-export async function uploadImageAnalysis(file: File, threadId: string, currentPage: string, message?: string) {
+// Reads the backend's SSE reply: `delta` frames, then `event: done` (or `event: error`).
+async function readAgentStream(body: ReadableStream<Uint8Array>, onDelta?: (text: string) => void) {
+  const reader = body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let response = "";
+  let interpreted_intent: string | undefined;
+  let awaiting_confirmation = false;
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const frame = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of frame.split("\n")) {
+        if (line.startsWith("event: ")) event = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      }
+      if (!data) continue;
+
+      const payload = JSON.parse(data);
+      if (event === "error") {
+        throw new Error(payload.detail);
+      } else if (event === "intent") {
+        interpreted_intent = payload.interpreted_intent;
+      } else if (event === "done") {
+        awaiting_confirmation = payload.awaiting_confirmation;
+      } else if (payload.delta) {
+        response += payload.delta;
+        onDelta?.(response);
+      }
+    }
+  }
+
+  return { response, interpreted_intent, awaiting_confirmation };
+}
+
+export async function uploadImageAnalysis(
+  file: File,
+  threadId: string,
+  currentPage: string,
+  message?: string,
+  onDelta?: (text: string) => void
+) {
   const formData = new FormData();
   formData.append("image", file);
   formData.append("thread_id", threadId);
@@ -176,5 +240,6 @@ export async function uploadImageAnalysis(file: File, threadId: string, currentP
     method: "POST",
     body: formData,
   });
-  return res.json();
+  if (!res.ok || !res.body) throw new Error("Failed to analyze image");
+  return readAgentStream(res.body, onDelta);
 }
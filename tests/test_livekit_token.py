@@ -0,0 +1,30 @@
+import asyncio
+
+import httpx
+import pytest
+from livekit.api import TokenVerifier
+
+import main
+
+
+def test_token_verifies_with_livekit():
+    token = main._livekit_jwt("room-verify", "alice")
+    claims = TokenVerifier(main.LIVEKIT_API_KEY, main.LIVEKIT_API_SECRET).verify(token)
+    assert claims.identity == "alice"
+    assert claims.name == "alice"
+    assert claims.video.room == "room-verify"
+    assert claims.video.room_join and claims.video.can_publish and claims.video.can_subscribe
+
+
+@pytest.mark.parametrize("body", [
+    {"room_name": "", "participant_name": "alice"},
+    {"room_name": "room", "participant_name": "  "},
+])
+def test_empty_room_or_identity_is_rejected(body):
+    async def post():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/api/livekit-token", json=body)
+
+    response = asyncio.run(post())
+    assert response.status_code == 400
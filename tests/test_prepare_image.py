@@ -0,0 +1,36 @@
+from io import BytesIO
+
+from PIL import Image
+
+from main import _prepare_image
+
+ORIENTATION = 0x0112
+
+
+def _jpeg(size, orientation=None):
+    """A JPEG whose stored pixels are `size`, optionally tagged with an EXIF Orientation."""
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[ORIENTATION] = orientation
+    buf = BytesIO()
+    Image.new("RGB", size, "white").save(buf, format="JPEG", exif=exif)
+    buf.seek(0)
+    return buf
+
+
+def test_rotated_photo_is_made_upright_and_downscaled():
+    # Stored landscape, tagged "rotate 90° CW": a portrait phone photo
+    out = Image.open(BytesIO(_prepare_image(_jpeg((2048, 1536), orientation=6), "image/jpeg")))
+    assert out.size == (768, 1024)
+    assert out.getexif().get(ORIENTATION, 1) == 1
+
+
+def test_small_rotated_photo_is_still_transposed():
+    out = Image.open(BytesIO(_prepare_image(_jpeg((400, 300), orientation=6), "image/jpeg")))
+    assert out.size == (300, 400)
+    assert out.getexif().get(ORIENTATION, 1) == 1
+
+
+def test_small_upright_photo_passes_through_unchanged():
+    original = _jpeg((400, 300))
+    assert _prepare_image(original, "image/jpeg") == original.getvalue()